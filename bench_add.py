@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections import defaultdict
+
+import aioredis
+
+from config import conf
+from models.proxy import Proxy, ProxyManager
+
+# needs a running redis, the benchmark only touches its own keys in bench_db
+bench_db = 15
+sync_sizes = [100, 1000, 5000]
+pattern_str = 'bench_add_pattern'
+
+
+async def old_add_proxies(pom, proxies, pattern_str):
+    # ProxyManager._add_proxies before ADD_SCRIPT, a pipeline of reads then one transaction per pool
+    keys = sorted({pattern_str, 'public_proxies'})
+    tr = pom.redis.pipeline()
+    futs = [(tr.hmget(p + '_fail', *map(str, proxies)), tr.hmget(p, *map(str, proxies))) for p in keys]
+    await tr.execute()
+    fails = [fail_fut.result() for fail_fut, _ in futs]
+    exists = {p: members_fut.result() for p, (_, members_fut) in zip(keys, futs)}
+
+    now = int(time.time())
+    expired = defaultdict(list)
+    selected = list()
+    for i, proxy in enumerate(proxies):
+        renewed = list()
+        for p, records in zip(keys, fails):
+            if records[i] is None:
+                continue
+            if now - (Proxy.loads(records[i], str(proxy)).delete_time or 0) < pom.RENEW_TIME:
+                break
+            renewed.append(p)
+        else:
+            if exists[pattern_str][i] is not None:
+                continue
+            for p in renewed:
+                expired[p].append(str(proxy))
+            selected.append(i)
+
+    for p in keys:
+        if expired[p]:
+            await pom.redis.hdel(p + '_fail', *expired[p])
+        new = [Proxy.loads(proxies[i].dumps(), str(proxies[i])) for i in selected if exists[p][i] is None]
+        if new:
+            tr = pom.redis.multi_exec()
+            tr.hmset_dict(p, {str(proxy): proxy.dumps() for proxy in new})
+            tr.incr(pom.cache.version_key(p))
+            _, version = await tr.execute()
+            pom.cache.apply(p, version, put=new)
+    return len(selected)
+
+
+async def clear(redis):
+    await redis.delete(*[p + suffix for p in [pattern_str, 'public_proxies'] for suffix in ['', '_fail', '_version']])
+
+
+async def reset(redis, proxies):
+    await clear(redis)
+    await redis.hmset_dict('public_proxies', {str(proxy): proxy.dumps() for proxy in proxies})
+
+
+async def bench_add():
+    redis = await aioredis.create_redis_pool('redis://{}:{}/{}'.format(conf.redis_host, conf.redis_port, bench_db),
+                                             password=conf.redis_password, encoding='utf8')
+    print("{:>8} {:>14} {:>14} {:>9}".format('proxies', 'old (ms)', 'script (ms)', 'speedup'))
+    try:
+        for size in sync_sizes:
+            proxies = [Proxy('10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256), 8080) for i in range(size)]
+
+            await reset(redis, proxies)
+            pom = ProxyManager(conf, redis)
+            start = time.time()
+            await old_add_proxies(pom, await pom.proxies(pattern_str='public_proxies'), pattern_str)
+            old_t = (time.time() - start) * 1e3
+            assert await redis.hlen(pattern_str) == size
+
+            await reset(redis, proxies)
+            pom = ProxyManager(conf, redis)
+            start = time.time()
+            await pom.sync_public(pattern_str)
+            new_t = (time.time() - start) * 1e3
+            assert await redis.hlen(pattern_str) == size
+
+            print("{:>8} {:>14.1f} {:>14.1f} {:>8.1f}x".format(size, old_t, new_t, old_t / new_t))
+    finally:
+        await clear(redis)
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(bench_add())
@@ -0,0 +1,65 @@
+import sys
+import timeit
+import traceback
+
+from lxml import etree
+
+from config import conf
+from models.pattern import Checker
+
+page_sizes = [50 * 1024, 500 * 1024, 2 * 1024 * 1024]
+number = 20
+rules = [
+    ('whitelist hit', 'whitelist', 'rating_num'),
+    ('whitelist miss', 'whitelist', 'not-on-page'),
+    ('xpath hit', '//span[@class="rating_num"]/text()', '9.7'),
+    ('xpath miss', '//span[@class="rating_num"]/text()', '1.0'),
+]
+
+
+def make_page(size):
+    item = '<li><div class="item"><span class="title">肖申克的救赎</span><span class="other">' \
+           'The Shawshank Redemption</span><p>导演: 弗兰克·德拉邦特</p></div></li>\n'
+    body = item * (size // len(item.encode('utf-8')))
+    return '<html><head><title>top250</title></head><body><ol class="grid_view">' + body + \
+           '</ol><span class="rating_num">9.7</span></body></html>'
+
+
+def old_check(status_code, text, rule, value, global_blacklist):
+    # Checker.check before rules were compiled per pattern
+    if not (status_code == 404 or status_code < 400):
+        return 'status_code check failed, get {}'.format(status_code)
+    for word in global_blacklist:
+        if word in text:
+            return 'global blacklist check failed, get {}'.format(word)
+    if rule == 'whitelist':
+        if value not in text:
+            return 'whitelist check failed, {} not found'.format(value)
+    else:
+        try:
+            et = etree.HTML(text)
+            assert et.xpath(rule)[0] == value
+        except IndexError:
+            return 'xpath check failed, {} not found'.format(rule)
+        except AssertionError:
+            return 'xpath check failed, value not equal'
+        except Exception:
+            return ''.join(traceback.format_exception(*sys.exc_info()))
+
+
+def bench_checker():
+    checker = Checker(global_blacklist=conf.global_blacklist)
+    print("{:>8} {:>15} {:>10} {:>14} {:>9}".format('page', 'rule', 'old (ms)', 'compiled (ms)', 'speedup'))
+    for size in page_sizes:
+        body = make_page(size).encode('utf-8')
+        for name, rule, value in rules:
+            compiled = checker.compile(rule, value)
+            # the old path decoded the body first, as response.text() did
+            old_t = timeit.timeit(lambda: old_check(200, body.decode('utf-8'), rule, value, conf.global_blacklist),
+                                  number=number) / number * 1e3
+            new_t = timeit.timeit(lambda: compiled.check(200, body, 'utf-8'), number=number) / number * 1e3
+            print("{:>7}K {:>15} {:>10.2f} {:>14.2f} {:>8.1f}x".format(size // 1024, name, old_t, new_t, old_t / new_t))
+
+
+if __name__ == '__main__':
+    bench_checker()
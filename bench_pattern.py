@@ -0,0 +1,72 @@
+import json
+import random
+import re
+import timeit
+
+from pygtrie import CharTrie
+
+from models.pattern import CheckPatternTrie
+
+host_num = 1000
+paths_per_host = 10
+lookups = 100000
+
+
+class OldCheckPatternTrie(CharTrie):
+    # CheckPatternTrie before the host index
+
+    def __setitem__(self, key, value):
+        super(OldCheckPatternTrie, self).__setitem__(self._remove_http_prefix(key), value)
+
+    def closest_pattern(self, url):
+        url = self._remove_http_prefix(url)
+        step = self.longest_prefix(url)
+        pattern_str, check_rule_json = step.key, step.value
+        if pattern_str is None:
+            pattern_str, check_rule_json = 'public_proxies', json.dumps({'rule': None, 'value': None})
+        return pattern_str, check_rule_json
+
+    @staticmethod
+    def _remove_http_prefix(url):
+        if url.startswith('http'):
+            url = re.sub(r'https?://', '', url, 1)
+        return url
+
+
+def make_patterns():
+    patterns = dict()
+    for h in range(host_num):
+        host = 'www.site{}.example.com'.format(h)
+        for p in range(paths_per_host):
+            pattern = '{}/category{}/item/'.format(host, p)
+            patterns[pattern] = json.dumps({'pattern': pattern, 'rule': 'whitelist', 'value': 'ok'})
+    return patterns
+
+
+def make_urls(distinct, hosts=host_num * 2):
+    urls = list()
+    for i in range(lookups):
+        h = random.randrange(hosts)
+        path = '/category{}/item/{}?page={}'.format(random.randrange(paths_per_host * 2),
+                                                    i if distinct else i % 100, random.randrange(50))
+        urls.append('http://www.site{}.example.com{}'.format(h, path))
+    return urls
+
+
+def bench_pattern():
+    patterns = make_patterns()
+    old, new = OldCheckPatternTrie(patterns), CheckPatternTrie(patterns)
+    print("{} patterns, {} lookups".format(len(patterns), lookups))
+    print("{:>22} {:>12} {:>12} {:>9}".format('urls', 'trie (us)', 'index (us)', 'speedup'))
+    for name, distinct, hosts in [('distinct items', True, host_num * 2),
+                                  ('repeated items', False, host_num * 2),
+                                  ('10 hot hosts', True, 10)]:
+        urls = make_urls(distinct, hosts)
+        assert [old.closest_pattern(u)[0] for u in urls[:1000]] == [new.closest_pattern(u)[0] for u in urls[:1000]]
+        old_t = timeit.timeit(lambda: [old.closest_pattern(u) for u in urls], number=1) / lookups * 1e6
+        new_t = timeit.timeit(lambda: [new.closest_pattern(u) for u in urls], number=1) / lookups * 1e6
+        print("{:>22} {:>12.2f} {:>12.2f} {:>8.1f}x".format(name, old_t, new_t, old_t / new_t))
+
+
+if __name__ == '__main__':
+    bench_pattern()
@@ -0,0 +1,53 @@
+import heapq
+import random
+import timeit
+
+from models.proxy import Proxy, ProxyPool, prefer_used_selector
+
+pool_sizes = [100, 10000, 100000]
+concurrent = 10
+number = 200
+
+
+def make_pool(size):
+    proxies = dict()
+    for i in range(size):
+        proxy = Proxy('10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256), 8080,
+                      support_https=random.random() < 0.5)
+        proxy.score = random.randint(-3, 5)
+        proxy.used = random.random() < 0.5
+        proxies[str(proxy)] = proxy
+    return ProxyPool(proxies)
+
+
+def old_greedy(pool):
+    proxies = list(pool.proxies.values())
+    return heapq.nlargest(concurrent, proxies, key=lambda p: prefer_used_selector(p.score, p.used))
+
+
+def old_combine(pool):
+    proxies = list(pool.proxies.values())
+    candidates = heapq.nlargest(2 * concurrent, proxies, key=lambda p: prefer_used_selector(p.score, p.used))
+    return random.sample(candidates, concurrent)
+
+
+def new_greedy(pool):
+    return pool.index.top(concurrent)
+
+
+def new_combine(pool):
+    return random.sample(pool.index.top(2 * concurrent), concurrent)
+
+
+def bench_selection():
+    print("{:>8} {:>8} {:>14} {:>14} {:>9}".format('size', 'mode', 'heapq (us)', 'index (us)', 'speedup'))
+    for size in pool_sizes:
+        pool = make_pool(size)
+        for mode, old, new in [('greedy', old_greedy, new_greedy), ('combine', old_combine, new_combine)]:
+            old_t = timeit.timeit(lambda: old(pool), number=number) / number * 1e6
+            new_t = timeit.timeit(lambda: new(pool), number=number) / number * 1e6
+            print("{:>8} {:>8} {:>14.1f} {:>14.1f} {:>8.0f}x".format(size, mode, old_t, new_t, old_t / new_t))
+
+
+if __name__ == '__main__':
+    bench_selection()
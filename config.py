@@ -11,10 +11,85 @@ class Config(object):
 
     # proxy
     port = 8893
+    # number of server processes sharing the port, see proxy_entrance.py --workers
+    workers = 1
+    # accept CONNECT on the same port and tunnel it through https proxies, see core/tunnel.py. only targets on
+    # connect_ports are tunnelled, and only through a proxy, never straight from this server
+    connect_tunnel = False
+    connect_ports = (443,)
     timeout = 10
+    # every upstream proxy gets its own connection pool, limits are per proxy and per target host through it
+    proxy_conn_limit = 20
+    proxy_conn_limit_per_host = 10
+    keepalive_timeout = 30
+    # selection skips proxies with proxy_max_inflight requests in flight or proxy_max_rate requests started
+    # this second (0 for no cap) while others are free, and prefers the least busy of equally scored proxies
+    proxy_max_inflight = 20
+    proxy_max_rate = 0
     concurrent = 10
+    # token buckets in proxy requests per second and caps on requests in flight, per target host and per pattern
+    # (0 for no limit, a pattern's own rate_limit and max_inflight go before the pattern ones here). a request
+    # waits at most limit_queue_timeout seconds for them and gets a 429 right away when that is not enough or
+    # limit_max_queue requests already wait on the same host or pattern. with limit_shared on the buckets live
+    # in redis and every worker leases limit_lease tokens at a time, in-flight caps are per worker
+    host_rate_limit = 0
+    host_max_inflight = 0
+    pattern_rate_limit = 0
+    pattern_max_inflight = 0
+    limit_queue_timeout = 5
+    limit_max_queue = 100
+    limit_shared = False
+    limit_lease = 10
+    # with adaptive_concurrent on, every pattern fans out to the fewest proxies, between concurrent_min and
+    # concurrent or the pattern's own bounds, that give a valid response within concurrent_latency_target
+    # (None for timeout) with probability concurrent_target (below 1), judged by the attempts of the last
+    # concurrent_window s. off by default, every request fans out to concurrent proxies
+    adaptive_concurrent = False
+    concurrent_min = 2
+    concurrent_target = 0.95
+    concurrent_latency_target = None
+    concurrent_window = 60
+    # pools under pool_low_watermark are refilled up to pool_size in the background
     pool_size = 50
+    pool_low_watermark = 20
     mode = 'combine'
+    # relay the winning response while it downloads, checks only see the first check_size bytes
+    stream = False
+    check_size = 256 * 1024
+    # request bodies over body_spool_size are spooled to a temp file and replayed from there to every proxy
+    body_spool_size = 1024 * 1024
+    # cache valid responses to GET and HEAD for cache_ttl seconds (0 for off) unless the pattern sets its own
+    # cache_ttl and cache_size. entries are told apart by method, url and cache_vary_headers, memory holds
+    # at most cache_max_bytes of bodies per process, cache_shared keeps them in redis for every worker too
+    cache_ttl = 0
+    cache_max_body_size = 1024 * 1024
+    cache_max_bytes = 64 * 1024 * 1024
+    cache_vary_headers = ('Accept', 'Accept-Encoding', 'Accept-Language', 'Authorization', 'Cookie', 'Need-Cookies')
+    cache_shared = False
+    # identical GET and HEAD requests (method, url, body and every end-to-end header) arriving while one of
+    # them is upstream wait for its response instead of crawling again, at most coalesce_max_waiters per request
+    coalesce = False
+    coalesce_max_waiters = 100
+    # hedged fan-out: start with the best proxy and add the next one each time the
+    # hedge_percentile of recent latencies passes without a valid response
+    hedge = False
+    hedge_percentile = 0.9
+    hedge_min_delay = 0.1
+    # parse xpath checks of pages over check_inline_size in a 'thread' or 'process' pool
+    # instead of on the event loop, at most check_max_pending at a time
+    check_executor = None
+    check_workers = 4
+    check_inline_size = 64 * 1024
+    check_max_pending = 64
+    # invalid responses saved for the dashboard keep their page text for a failure_sample_rate
+    # fraction only, text and request data are cut to failure_text_size characters
+    failure_sample_rate = 0.1
+    failure_text_size = 4096
+    # per pattern success and fail counts, one ring buffer per (resolution, retention) in seconds.
+    # the dashboard status chart shows the last status_points slots of the status_resolution series
+    counter_series = ((1, 5 * 60), (60, 24 * 60 * 60))
+    status_resolution = 60
+    status_points = 10
     global_blacklist = [
         'antispider',
         'forbidden',
@@ -22,6 +97,13 @@ class Config(object):
         'you\'ve successfully installed Tomcat'
     ]
 
+    # logging: records are written one by one by a background thread when log_async is on,
+    # each call site logs at most log_rate_limit records a second below ERROR (0 for no limit),
+    # log_format is 'text' or 'json'
+    log_async = True
+    log_rate_limit = 10
+    log_format = 'text'
+
     # dashboard
     dashboard_addr = 'http://127.0.0.1:8894'
     admin_token = {
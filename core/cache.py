@@ -0,0 +1,124 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import log_utils
+
+logger = log_utils.LogHandler('server', file=True)
+
+cache_stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'entries': 0, 'bytes': 0}
+
+
+class CachedResponse(object):
+    __slots__ = ('status', 'content_type', 'proxy', 'body', 'expire_at')
+
+    def __init__(self, status, content_type, proxy, body, expire_at):
+        self.status = status
+        self.content_type = content_type
+        self.proxy = proxy
+        self.body = body
+        self.expire_at = expire_at
+
+    def dumps(self):
+        # a json head line followed by the raw body, bodies are not always text
+        head = json.dumps({'status': self.status, 'content_type': self.content_type, 'proxy': self.proxy,
+                           'expire_at': self.expire_at})
+        return head.encode() + b'\n' + self.body
+
+    @classmethod
+    def loads(cls, b):
+        head, body = b.split(b'\n', 1)
+        d = json.loads(head.decode())
+        return cls(d['status'], d['content_type'], d['proxy'], body, d['expire_at'])
+
+    def __len__(self):
+        return len(self.body)
+
+
+class ResponseCache(object):
+    # valid responses to GET and HEAD in a memory LRU bounded by body bytes, and in redis when
+    # shared is on so every worker sees them. ttl and max body size come from the pattern,
+    # a pattern without them uses the defaults, a ttl of 0 turns caching off
+    KEY_PREFIX = 'response_cache_'
+    METHODS = ('GET', 'HEAD')
+    # cacheable by default, the others a check lets through (206, 302, 303, 307 ...) are not stored
+    STATUSES = (200, 203, 204, 300, 301, 308, 404)
+
+    def __init__(self, redis, max_bytes, ttl=0, max_body_size=1024 * 1024, vary_headers=(), shared=False):
+        self.redis = redis
+        self.max_bytes = max_bytes
+        self.default_ttl = ttl
+        self.default_max_body_size = max_body_size
+        self.vary_headers = vary_headers
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def ttl(self, pattern):
+        return self.default_ttl if pattern.cache_ttl is None else pattern.cache_ttl
+
+    def max_body_size(self, pattern):
+        return self.default_max_body_size if pattern.cache_size is None else pattern.cache_size
+
+    def key(self, method, url, headers, pattern, body=None):
+        # None when the request can not be served from cache
+        if pattern is None or method not in self.METHODS or body is not None or self.ttl(pattern) <= 0:
+            return None
+        parts = [method, url] + ['{}: {}'.format(h, ','.join(headers.getall(h, []))) for h in self.vary_headers]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8', errors='replace')).hexdigest()
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expire_at <= time.time():
+            self._remove(key)
+            entry = None
+        if entry is None and self.shared:
+            try:
+                b = await self.redis.get(self.KEY_PREFIX + key, encoding=None)
+            except Exception as e:
+                logger.warning("unable to read cached response, {}".format(e))
+                b = None
+            if b is not None:
+                entry = CachedResponse.loads(b)
+                if entry.expire_at > time.time():
+                    self._put(key, entry)
+                else:
+                    entry = None
+        if entry is None:
+            cache_stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        cache_stats['hits'] += 1
+        return entry
+
+    async def set(self, key, pattern, status, content_type, proxy, body):
+        ttl = self.ttl(pattern)
+        if status not in self.STATUSES or len(body) > min(self.max_body_size(pattern), self.max_bytes):
+            return
+        entry = CachedResponse(status, content_type, proxy, body, time.time() + ttl)
+        self._put(key, entry)
+        cache_stats['stored'] += 1
+        if self.shared:
+            try:
+                await self.redis.set(self.KEY_PREFIX + key, entry.dumps(), expire=max(int(ttl), 1))
+            except Exception as e:
+                logger.warning("unable to share cached response, {}".format(e))
+
+    def _put(self, key, entry):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._size += len(entry)
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            cache_stats['evicted'] += 1
+        cache_stats['entries'], cache_stats['bytes'] = len(self._entries), self._size
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry)
+        cache_stats['entries'], cache_stats['bytes'] = len(self._entries), self._size
+
+    def __len__(self):
+        return len(self._entries)
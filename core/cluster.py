@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import socket
+import time
+
+import log_utils
+from config import conf
+from core import metrics
+from core.cache import cache_stats
+from core.coalesce import flight_stats
+from core.crawler import fanout_stats, proxy_load, session_stats
+from core.limiter import limit_stats
+from core.tunnel import tunnel_stats
+
+logger = log_utils.LogHandler(__name__, file=True)
+
+
+def _merge(a, b):
+    merged = dict(a)
+    for k, v in b.items():
+        if isinstance(v, dict):
+            merged[k] = _merge(merged.get(k, dict()), v)
+        elif isinstance(v, list):
+            merged[k] = [a + b for a, b in zip(merged[k], v)] if k in merged else list(v)
+        elif isinstance(v, (int, float)) and k != 'time':
+            merged[k] = merged.get(k, 0) + v
+    return merged
+
+
+class ClusterStats(object):
+    # every worker publishes a snapshot of its in-process counters, the dashboard sums them up
+    KEY = 'proxy_tower_workers'
+    PUBLISH_INTERVAL = 2
+    STALE_TIME = 10
+
+    def __init__(self, redis, saver, pattern_manager, workers=1):
+        self.redis = redis
+        self.saver = saver
+        self.pattern_manager = pattern_manager
+        self.workers = workers
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._publish_task = None
+
+    async def __aenter__(self):
+        if self.workers > 1:
+            self._publish_task = asyncio.ensure_future(self._publish_loop())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._publish_task is not None:
+            self._publish_task.cancel()
+            await self.redis.hdel(self.KEY, self.worker_id)
+
+    def snapshot(self):
+        return {
+            'time': int(time.time()),
+            'success_count': self.saver.success_count,
+            'total_count': self.saver.total_count,
+            'fanout': dict(fanout_stats),
+            'tunnel': dict(tunnel_stats),
+            'sessions': dict(session_stats),
+            'cache': dict(cache_stats),
+            'flights': dict(flight_stats),
+            'limits': dict(limit_stats),
+            'load': proxy_load.stats(conf.proxy_max_inflight, conf.proxy_max_rate),
+            'metrics': metrics.snapshot(),
+            'patterns': self.pattern_manager.counters()
+        }
+
+    async def _publish_loop(self):
+        while True:
+            try:
+                await self.redis.hset(self.KEY, self.worker_id, json.dumps(self.snapshot()))
+                # patterns added or deleted through another worker's dashboard
+                await self.pattern_manager.refresh()
+            except Exception as e:
+                logger.warning("unable to sync worker state, {}".format(e), exc_info=True)
+            await asyncio.sleep(self.PUBLISH_INTERVAL)
+
+    async def merged(self):
+        merged = self.snapshot()
+        if self.workers <= 1:
+            return merged
+        d = await self.redis.hgetall(self.KEY)
+        for worker_id, j in d.items():
+            if worker_id == self.worker_id:
+                continue
+            snapshot = json.loads(j)
+            if merged['time'] - snapshot['time'] > self.STALE_TIME:
+                continue
+            merged = _merge(merged, snapshot)
+        return merged
@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+
+flight_stats = {'leaders': 0, 'followers': 0, 'overflow': 0, 'fallbacks': 0}
+
+# these only concern the connection to this server, every other header may change the response
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                        'transfer-encoding', 'upgrade', 'proxy-connection'))
+
+
+def _end_to_end(headers):
+    hop_by_hop = set(HOP_BY_HOP)
+    for value in headers.getall('Connection', []):
+        hop_by_hop.update(token.strip().lower() for token in value.split(','))
+    # sorted by name only, repeated headers keep their order
+    return sorted(((name.lower(), value) for name, value in headers.items() if name.lower() not in hop_by_hop),
+                  key=lambda header: header[0])
+
+
+class _Flight(object):
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self):
+        self.future = asyncio.get_event_loop().create_future()
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    # identical GET and HEAD requests arriving while one of them is upstream wait for its result instead of
+    # fanning out again, at most max_waiters of them per request. a leader that streams, fails
+    # with an exception or goes away leaves its followers to do their own request
+    def __init__(self, max_waiters):
+        self.max_waiters = max_waiters
+        self._flights = dict()
+
+    def key(self, method, url, headers, body=None):
+        # None when the request can not be shared: other methods are not safe to replay, bodies spooled
+        # to disk are not hashed. requests only share when all their end-to-end headers are the same
+        if method not in ('GET', 'HEAD'):
+            return None
+        body_hash = ''
+        if body is not None:
+            digest = body.digest()
+            if digest is None:
+                return None
+            body_hash = digest
+        parts = [method, url, body_hash] + ['{}: {}'.format(name, value) for name, value in _end_to_end(headers)]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8', errors='replace')).hexdigest()
+
+    async def do(self, key, fn, replay):
+        # fn() returns (response, shared), followers get replay(shared) or call fn themselves when shared is None
+        flight = self._flights.get(key)
+        if flight is None:
+            return await self._lead(key, fn)
+        if flight.waiters >= self.max_waiters:
+            flight_stats['overflow'] += 1
+            response, _ = await fn()
+            return response
+        flight.waiters += 1
+        try:
+            shared = await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            if not flight.future.cancelled():
+                raise
+            shared = None
+        finally:
+            flight.waiters -= 1
+        if shared is None:
+            flight_stats['fallbacks'] += 1
+            response, _ = await fn()
+            return response
+        flight_stats['followers'] += 1
+        return replay(shared)
+
+    async def _lead(self, key, fn):
+        flight = self._flights[key] = _Flight()
+        flight_stats['leaders'] += 1
+        try:
+            response, shared = await fn()
+            flight.future.set_result(shared)
+            return response
+        finally:
+            if not flight.future.done():
+                flight.future.cancel()
+            del self._flights[key]
@@ -1,39 +1,153 @@
 import asyncio
-import sys
-import traceback
+import time
+from collections import OrderedDict, defaultdict, deque
 
 import aiohttp
 
 import log_utils
 from config import conf
-from models.response import FailedResponse, Response
+from core import metrics
+from models.request import RequestBody
+from models.response import FailedResponse, Failure, Response
 
 logger = log_utils.LogHandler(__name__, file=True)
 
 
-def init_session():
-    conn = aiohttp.TCPConnector(limit=500, ttl_dns_cache=30*60)
-    return aiohttp.ClientSession(connector=conn)
+session_stats = {'connections': 0, 'reused': 0, 'connect_time': 0}
 
 
-async def _crawl(method, url, session, **kwargs):
+async def _on_connection_create_start(session, ctx, params):
+    ctx.connect_start = time.time()
+
+
+async def _on_connection_create_end(session, ctx, params):
+    session_stats['connections'] += 1
+    session_stats['connect_time'] += time.time() - ctx.connect_start
+
+
+async def _on_connection_reuseconn(session, ctx, params):
+    session_stats['reused'] += 1
+
+
+def _trace_config():
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(_on_connection_create_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    return trace_config
+
+
+class SessionPool(object):
+    # one ClientSession per proxy: keep-alive connections to a proxy are reused across requests,
+    # and a slow proxy can only hold up its own connections. a session evicted while requests
+    # still use it is closed once the last of them is done
+    MAX_SESSIONS = 2000
+
+    def __init__(self, limit, limit_per_host, keepalive_timeout):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._sessions = OrderedDict()
+        self._inflight = dict()
+        self._retired = set()
+        self._trace_config = _trace_config()
+
+    def get(self, proxy=None):
+        key = str(proxy)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            conn = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                        keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=30*60)
+            session = aiohttp.ClientSession(connector=conn, trace_configs=[self._trace_config])
+            self._sessions[key] = session
+            if len(self._sessions) > self.MAX_SESSIONS:
+                _, old = self._sessions.popitem(last=False)
+                if self._inflight.get(old):
+                    self._retired.add(old)
+                else:
+                    asyncio.ensure_future(old.close())
+        else:
+            self._sessions.move_to_end(key)
+        return session
+
+    def acquire(self, proxy=None):
+        session = self.get(proxy)
+        self._inflight[session] = self._inflight.get(session, 0) + 1
+        return session
+
+    def release(self, session):
+        n = self._inflight.pop(session, 0) - 1
+        if n > 0:
+            self._inflight[session] = n
+        elif session in self._retired:
+            self._retired.discard(session)
+            asyncio.ensure_future(session.close())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def close(self):
+        sessions = list(self._sessions.values()) + list(self._retired)
+        self._sessions, self._inflight, self._retired = OrderedDict(), dict(), set()
+        await asyncio.gather(*[session.close() for session in sessions])
+
+
+# set up by the app's startup hook, see core/proxy_server.py
+session_pool = None
+
+
+def open_session_pool(limit, limit_per_host, keepalive_timeout):
+    global session_pool
+    session_pool = SessionPool(limit, limit_per_host, keepalive_timeout)
+    return session_pool
+
+
+def _release(r):
+    if hasattr(r, 'release'):
+        r.release()
+
+
+async def _crawl(method, url, session, stream=False, **kwargs):
     proxy = kwargs.get('proxy')
     if proxy is not None:
         kwargs['proxy'] = str(proxy)
     kwargs.update({'ssl': False, 'timeout': kwargs.get('timeout') or conf.timeout})
+    data = kwargs.get('data')
+    if isinstance(data, RequestBody):
+        # every attempt of a fan-out replays the body on its own
+        kwargs['data'] = data.payload()
+    r = None
+    start = time.time()
     try:
-        async with session.request(method, url, **kwargs) as r:
+        if stream:
+            # the connection stays open, whoever ends up with the response releases it
+            r = await session.request(method, url, **kwargs)
             r.__class__ = Response
-            r.request_data = kwargs.get('data')
-            await r.read()
+            r.request_data = data
+            await r.read_prefix(conf.check_size)
+        else:
+            async with session.request(method, url, **kwargs) as r:
+                r.__class__ = Response
+                r.request_data = data
+                await r.read()
     except asyncio.CancelledError:
+        if stream and r is not None:
+            r.close()
         r = FailedResponse()
         r.cancelled = True
     except Exception as e:
+        if stream and r is not None:
+            r.close()
         r = FailedResponse()
-        r.traceback = str(proxy) + '\n' + ''.join(traceback.format_exception(*sys.exc_info())) + '\n'
-        logger.warning(e, exc_info=True)
+        failure = Failure.from_exception(proxy, e)
+        r.add_failure(failure)
+        # network errors are expected from free proxies, only unexpected ones get a traceback in the log
+        logger.warning("{} via {}, {}".format(failure.reason, proxy, failure.detail),
+                       exc_info=failure.reason == 'error')
     r.proxy = proxy
+    r.elapsed = time.time() - start
+    if not r.cancelled:
+        metrics.upstream_seconds.observe(r.elapsed)
     return r
 
 
@@ -41,52 +155,183 @@ async def _crawl_with_check(method, url, session, pattern, **kwargs):
     r = await _crawl(method, url, session, **kwargs)
     if hasattr(r, 'cancelled') and r.cancelled:
         return r
-    await pattern.check(r)
+    try:
+        await pattern.check(r)
+    except BaseException:
+        _release(r)
+        raise
+    if not r.valid:
+        _release(r)
     return r
 
 
-async def crawl(method, url, proxies=None, **kwargs):
-    if proxies is None:
-        proxies = list()
-    if len(proxies) == 0:
-        proxies.append(None)
+class LatencyWindow(object):
 
-    pattern = kwargs.pop('pattern', None)
-    session = kwargs.pop('session', None)
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
 
-    need_close_session = False
-    if session is None:
-        need_close_session = True
-        session = aiohttp.ClientSession()
+    def record(self, elapsed):
+        self.samples.append(elapsed)
 
-    result = FailedResponse()
-    need_check = pattern is not None
-    try:
-        if need_check:
-            tasks = [asyncio.ensure_future(_crawl_with_check(method, url, session, pattern,
-                                                             proxy=proxy, **kwargs)) for proxy in proxies]
+    def percentile(self, q, default=None):
+        if not self.samples:
+            return default
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+latency_windows = defaultdict(LatencyWindow)
+fanout_stats = {'requests': 0, 'planned': 0, 'launched': 0, 'bytes': 0}
+
+
+class ProxyLoad(object):
+    # requests in flight and started in the current second per proxy, counted over every pattern.
+    # selection skips proxies at max_inflight or max_rate (0 for no cap) and prefers the least busy of equals
+    def __init__(self):
+        self.inflight = dict()
+        self.started = dict()
+        self.skipped = 0
+        self._second = 0
+
+    def start(self, proxy_str):
+        self._roll()
+        self.inflight[proxy_str] = self.inflight.get(proxy_str, 0) + 1
+        self.started[proxy_str] = self.started.get(proxy_str, 0) + 1
+
+    def finish(self, proxy_str):
+        n = self.inflight.get(proxy_str, 0) - 1
+        if n > 0:
+            self.inflight[proxy_str] = n
         else:
-            tasks = [asyncio.ensure_future(_crawl(method, url, session, proxy=proxy, **kwargs))
-                     for proxy in proxies]
-        for task in asyncio.as_completed(tasks):
-            try:
-                r = await task
-            except asyncio.CancelledError:
-                continue
-            if (need_check and r.valid) or not need_check:
-                for t in tasks:
-                    if not t.done():
-                        t.cancel()
-                result = r
+            self.inflight.pop(proxy_str, None)
+
+    def _roll(self):
+        second = int(time.time())
+        if second != self._second:
+            self._second = second
+            self.started.clear()
+
+    def rate(self, proxy_str):
+        self._roll()
+        return self.started.get(proxy_str, 0)
+
+    def saturated(self, proxy_str, max_inflight, max_rate):
+        return bool((max_inflight and self.inflight.get(proxy_str, 0) >= max_inflight) or
+                    (max_rate and self.rate(proxy_str) >= max_rate))
+
+    def stats(self, max_inflight, max_rate):
+        # a proxy at its rate cap may have nothing in flight
+        self._roll()
+        saturated = sum(1 for proxy_str in set(self.inflight) | set(self.started)
+                        if self.saturated(proxy_str, max_inflight, max_rate))
+        return {'inflight': dict(self.inflight), 'saturated': saturated, 'skipped': self.skipped}
+
+
+proxy_load = ProxyLoad()
+
+
+def _observe(window, r, need_check, elapsed):
+    # every completed attempt counts, not just winners, so slow and failing proxies push the hedge delay up
+    latency_windows[window].record(elapsed)
+    if need_check and hasattr(r.proxy, 'latency'):
+        r.proxy.latency.record(elapsed, r.valid)
+    fanout_stats['bytes'] += len(getattr(r, '_body', None) or getattr(r, 'prefix', None) or b'')
+
+
+def _hedge_delay(window, proxy):
+    delay = None
+    if hasattr(proxy, 'latency') and proxy.latency.count >= 10:
+        delay = proxy.latency.percentile(conf.hedge_percentile)
+    if delay is None:
+        delay = latency_windows[window].percentile(conf.hedge_percentile, conf.hedge_min_delay)
+    return min(max(delay, conf.hedge_min_delay), conf.timeout)
+
+
+async def race(attempt, proxies, need_check=True, hedge=False, window=None):
+    # runs attempt(proxy) for the proxies and returns the first valid result, the others are released.
+    # results need valid, cancelled, failures and proxy, and a release() if they hold a connection
+    failed = FailedResponse()
+    result = failed
+    started = dict()
+
+    def launch():
+        proxy = proxies[len(started)]
+        task = asyncio.ensure_future(attempt(proxy))
+        started[task] = time.time()
+        if proxy is not None:
+            proxy_load.start(str(proxy))
+            task.add_done_callback(lambda _: proxy_load.finish(str(proxy)))
+        return task
+
+    # with hedge on, proxies are started one by one in the given order: the next one goes
+    # out when the current ones are slower than the recent latency percentile, or fail
+    pending = {launch() for _ in range(1 if hedge else len(proxies))}
+    try:
+        while pending:
+            delay = _hedge_delay(window, proxies[len(started) - 1]) if len(started) < len(proxies) else None
+            done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                r = task.result()
+                if r.cancelled:
+                    continue
+                _observe(window, r, need_check, time.time() - started[task])
+                if winner is None and ((need_check and r.valid) or not need_check):
+                    winner = task
+                    result = r
+                else:
+                    if not r.valid:
+                        for failure in r.failures:
+                            failed.add_failure(failure)
+                        logger.debug("{} via {} is invalid, trying other proxies".format(window, r.proxy))
+                    _release(r)
+            if winner is not None:
                 break
-            else:
-                if result.traceback is None:
-                    result.traceback = ''
-                result.traceback += r.traceback
-                logger.debug("response from {} for {} is invalid, trying other proxies".format(r.proxy, url))
+            # a timeout or a failed attempt both open a slot for the next proxy
+            for _ in range(min(max(len(done), 1), len(proxies) - len(started))):
+                pending.add(launch())
         return result
     except Exception as e:
         logger.error(e, exc_info=True)
     finally:
-        if need_close_session:
-            await session.close()
+        for t in pending:
+            t.cancel()
+        metrics.cancelled.inc(len(pending))
+        metrics.fanout_width.observe(len(started))
+        fanout_stats['requests'] += 1
+        fanout_stats['planned'] += len(proxies)
+        fanout_stats['launched'] += len(started)
+
+
+async def crawl(method, url, proxies=None, **kwargs):
+    if proxies is None:
+        # requests of this server itself, like fetching proxy apis, go out directly
+        proxies = [None]
+    elif len(proxies) == 0:
+        # a client request with no proxy to go through fails, it never goes out from this server's address
+        r = FailedResponse()
+        r.add_failure(Failure(None, 'no_proxy', 'no proxy available'))
+        return r
+
+    pattern = kwargs.pop('pattern', None)
+    hedge = kwargs.pop('hedge', False)
+    need_check = pattern is not None
+
+    async def attempt(proxy):
+        pool = session_pool
+        session = pool.acquire(proxy)
+        r = None
+        try:
+            if need_check:
+                r = await _crawl_with_check(method, url, session, pattern, proxy=proxy, **kwargs)
+            else:
+                r = await _crawl(method, url, session, proxy=proxy, **kwargs)
+            return r
+        finally:
+            if getattr(r, '_connection', None) is not None:
+                # a streamed response still reads from the session
+                r.on_release(lambda: pool.release(session))
+            else:
+                pool.release(session)
+
+    return await race(attempt, proxies, need_check=need_check, hedge=hedge, window=str(pattern))
@@ -3,7 +3,9 @@ import json
 
 from aiohttp import web
 
+from core.metrics import render as render_metrics
 from core.crawler import crawl
+from models.pattern import Pattern
 from models.response import FailedResponse
 
 dashboard_data_template = {
@@ -28,6 +30,7 @@ async def dashboard(request):
         '/prod-api/config': config,
         '/prod-api/recent_failed_request': recent_failed_request,
         '/prod-api/debug': debug,
+        '/metrics': metrics,
     }
     path = request.path
     if path in dashboard_router:
@@ -91,7 +94,8 @@ async def logout(request):
 
 async def status(request):
     r = copy.deepcopy(dashboard_data_template)
-    x, items = request.app['pam'].status()
+    stats = await request.app['cluster'].merged()
+    x, items = request.app['pam'].status(stats['patterns'])
     r['data']['items'] = items
     r['data']['x'] = x
     r['data']['total'] = len(r['data']['items'])
@@ -99,15 +103,51 @@ async def status(request):
 
 
 async def index(request):
+    stats = await request.app['cluster'].merged()
+    connections, reused = stats['sessions']['connections'], stats['sessions']['reused']
+    hits, misses = stats['cache']['hits'], stats['cache']['misses']
+    launched = stats['fanout']['launched']
+    avoided = stats['fanout']['planned'] - launched
     data = {
         'proxy_count': await request.app['pom'].proxy_count('public_proxies'),
         'pattern_count': await request.app['pam'].pattern_count(),
-        'success_requests': request.app['sv'].success_count,
-        'total_requests': request.app['sv'].total_count
+        'success_requests': stats['success_count'],
+        'total_requests': stats['total_count'],
+        'planned_proxy_requests': stats['fanout']['planned'],
+        'sent_proxy_requests': stats['fanout']['launched'],
+        'avoided_proxy_attempts': avoided,
+        # attempts hedging never started, times the bytes an attempt received on average
+        'saved_bytes': round(avoided * stats['fanout']['bytes'] / launched) if launched else 0,
+        'tunnel_requests': stats['tunnel']['requests'],
+        'active_tunnels': stats['tunnel']['active'],
+        'tunnel_bytes_sent': stats['tunnel']['bytes_sent'],
+        'tunnel_bytes_received': stats['tunnel']['bytes_received'],
+        'upstream_connections': connections,
+        'connection_reuse_ratio': round(reused / (connections + reused), 3) if connections + reused else None,
+        'avg_connect_time': round(stats['sessions']['connect_time'] / connections, 3) if connections else None,
+        'cache_hits': hits,
+        'cache_misses': misses,
+        'cache_hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+        'cache_entries': stats['cache']['entries'],
+        'cache_bytes': stats['cache']['bytes'],
+        'coalesced_requests': stats['flights']['followers'],
+        'queued_requests': stats['limits']['queued'],
+        'rate_limited_requests': stats['limits']['rejected'],
+        'busy_proxies': len(stats['load']['inflight']),
+        'proxy_requests_in_flight': sum(stats['load']['inflight'].values()),
+        'saturated_proxies': stats['load']['saturated'],
+        'saturated_proxy_skips': stats['load']['skipped'],
+        'fanout_widths': request.app['pam'].widths()
     }
     return web.json_response(data={'code': 20000, 'data': data})
 
 
+async def metrics(request):
+    stats = await request.app['cluster'].merged()
+    text = render_metrics(stats, request.app['pom'].cache.loaded(), request.app['pam'].widths())
+    return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+
 async def user_info(request):
     return web.json_response(data={'code': 20000, 'data': request.app['config'].admin_token})
 
@@ -115,7 +155,8 @@ async def user_info(request):
 async def pattern(request):
     d = await request.json()
     if request.method == 'POST':
-        await request.app['pam'].add(d['pattern'], d['rule'], d['value'])
+        settings = {k: v for k, v in d.items() if k in Pattern.SETTINGS}
+        await request.app['pam'].add(d['pattern'], d['rule'], d['value'], **settings)
     elif request.method == 'DELETE':
         await request.app['pam'].delete(d['pattern'])
     return web.json_response(data={'code': 20000, 'message': 'success'})
@@ -133,7 +174,8 @@ async def recent_failed_request(request):
 
 
 async def config(request):
-    fields = ['mode', 'pool_size', 'concurrent', 'timeout']
+    fields = ['mode', 'pool_size', 'pool_low_watermark', 'concurrent', 'adaptive_concurrent', 'timeout', 'stream',
+              'hedge']
     if request.method == 'GET':
         data = dict()
         for k in fields:
@@ -1,50 +1,141 @@
 import json
+import time
+from urllib.parse import urlsplit
 
 from aiohttp import web
 from multidict import CIMultiDict
 
 import log_utils
+from core import metrics
 from core.crawler import crawl
+from core.limiter import RateLimited
 
 logger = log_utils.LogHandler('server', file=True)
 
 
+class RelayResponse(web.StreamResponse):
+
+    def __init__(self, upstream, **kwargs):
+        super(RelayResponse, self).__init__(**kwargs)
+        self._upstream = upstream
+
+    async def write_eof(self, data=b''):
+        # aiohttp calls this right after prepare(), pipe the rest of the upstream body here
+        try:
+            await self.write(self._upstream.prefix)
+            async for chunk in self._upstream.content.iter_any():
+                await self.write(chunk)
+        finally:
+            self._upstream.release()
+        await super(RelayResponse, self).write_eof(data)
+
+
 def _gen_headers(r):
     res_headers = CIMultiDict()
     if 'Set-Cookie' in r.headers:
         for cookie in r.headers.getall('Set-Cookie'):
             res_headers.add('Set-Cookie', cookie)
+    if 'Content-Type' in r.headers:
+        res_headers['Content-Type'] = r.headers['Content-Type']
     res_headers['Via-Proxy'] = str(r.proxy)
     return res_headers
 
 
 async def forward(method, url, pam, pom, **kwargs):
-    session = kwargs.get('session')
+    start = time.time()
+    try:
+        return await _forward(method, url, pam, pom, **kwargs)
+    finally:
+        metrics.forward_seconds.observe(time.time() - start)
+
+
+async def _forward(method, url, pam, pom, **kwargs):
     headers = kwargs.get('headers')
-    content = kwargs.get('content')
+    body = kwargs.get('body')
     mode = kwargs.get('mode', 'score')
+    stream = kwargs.get('stream', False)
+    hedge = kwargs.get('hedge', False)
+    cache = kwargs.get('cache')
+    flights = kwargs.get('flights')
+    limiter = kwargs.get('limiter')
 
     need_https = 'Need-Https' in headers
     if need_https:
         url = url.replace('http://', 'https://', 1)
 
     pattern_str, check_rule_json = pam.t.closest_pattern(url)
-    await cookies_handler(headers, pam, pattern_str)
-    await pom.add_proxies_for_pattern(pattern_str)
-    proxies = await pom.select_proxies(pattern_str, need_https=need_https,
-                                       prefer_used=True, mode=mode)
     pattern = pam.get_pattern(pattern_str)
-    r = await crawl(method, url, proxies, session=session, pattern=pattern, data=content, headers=headers)
-    if r is None or r.traceback or r.cancelled:
-        await pattern.counter(False)
-        text = 'unable to get any response' if r is None else r.traceback
-        logger.warning("unable to get any valid response for {}".format(url))
-        return web.Response(status=417, text=text)
-    else:
-        await pattern.counter(True)
-        text = await r.text()
-        logger.info("get valid response for {} via proxy {}".format(url, r.proxy))
-        return web.Response(status=r.status, text=text, headers=_gen_headers(r))
+    cache_key = None if cache is None else cache.key(method, url, headers, pattern, body)
+    if cache_key is not None:
+        cached = await cache.get(cache_key)
+        if cached is not None:
+            logger.info("get cached response for {}".format(url))
+            return _cached_response(cached)
+
+    async def fetch():
+        # the response for this client, and what identical requests waiting on it get: (status, headers, body),
+        # or None for a relayed stream which can only be sent once
+        await cookies_handler(headers, pam, pattern_str)
+        proxies = await pom.select_proxies(pattern_str, need_https=need_https,
+                                           prefer_used=True, mode=mode, concurrent=pattern.fanout_width())
+        if not proxies:
+            pattern.counter(False)
+            metrics.forward_failed.inc()
+            logger.warning("no proxy available for {}".format(url))
+            response = web.Response(status=503, text='no proxy available for {}'.format(pattern_str))
+            return response, (response.status, CIMultiDict(response.headers), response.body)
+        acquired = list()
+        if limiter is not None:
+            try:
+                acquired = await limiter.acquire(urlsplit(url).hostname or '', pattern, len(proxies))
+            except RateLimited as e:
+                logger.warning("reject {}, {}".format(url, e))
+                response = web.Response(status=429, text=str(e), headers={'Retry-After': str(e.retry_after)})
+                return response, (response.status, CIMultiDict(response.headers), response.body)
+        try:
+            r = await crawl(method, url, proxies, pattern=pattern, data=body, headers=headers,
+                            stream=stream, hedge=hedge)
+        finally:
+            if limiter is not None:
+                limiter.release(acquired)
+        if r is None or not r.valid:
+            pattern.counter(False)
+            metrics.forward_failed.inc()
+            text = 'unable to get any response' if r is None or r.traceback is None else r.traceback
+            logger.warning("unable to get any valid response for {}".format(url))
+            response = web.Response(status=417, text=text)
+            return response, (response.status, CIMultiDict(response.headers), response.body)
+        else:
+            pattern.counter(True)
+            logger.info("get valid response for {} via proxy {}".format(url, r.proxy))
+            if r.streaming:
+                return RelayResponse(r, status=r.status, headers=_gen_headers(r)), None
+            content = r.body
+            # only complete bodies that passed the check, and nothing that sets cookies
+            if cache_key is not None and 'Set-Cookie' not in r.headers:
+                await cache.set(cache_key, pattern, r.status, r.headers.get('Content-Type'), str(r.proxy), content)
+            res_headers = _gen_headers(r)
+            return web.Response(status=r.status, body=content, headers=res_headers), (r.status, res_headers, content)
+
+    flight_key = None if flights is None else flights.key(method, url, headers, body)
+    if flight_key is None:
+        response, _ = await fetch()
+        return response
+    return await flights.do(flight_key, fetch, _replay)
+
+
+def _replay(shared):
+    status, headers, body = shared
+    return web.Response(status=status, body=body, headers=CIMultiDict(headers))
+
+
+def _cached_response(cached):
+    headers = CIMultiDict()
+    if cached.content_type is not None:
+        headers['Content-Type'] = cached.content_type
+    headers['Via-Proxy'] = cached.proxy
+    headers['X-Cache'] = 'HIT'
+    return web.Response(status=cached.status, body=cached.body, headers=headers)
 
 
 async def cookies_handler(headers, pam, pattern_str):
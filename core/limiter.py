@@ -0,0 +1,223 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+import log_utils
+from core.script import Script
+
+logger = log_utils.LogHandler('server', file=True)
+
+limit_stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'leases': 0}
+
+# KEYS: bucket
+# ARGV: now in ms, rate per second, burst, tokens wanted, tokens needed at least.
+# grants up to the wanted tokens once the bucket holds the needed ones, otherwise nothing and
+# the ms until it will
+LEASE_SCRIPT = """
+local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local want, need = tonumber(ARGV[4]), tonumber(ARGV[5])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens, updated = tonumber(state[1]) or burst, tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate / 1000)
+local granted, wait = 0, 0
+if tokens >= need then
+    granted = math.min(want, math.floor(tokens))
+    tokens = tokens - granted
+else
+    wait = math.ceil((need - tokens) * 1000 / rate)
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {granted, wait}
+"""
+lease_script = Script(LEASE_SCRIPT)
+
+
+class RateLimited(Exception):
+
+    def __init__(self, key, retry_after):
+        super(RateLimited, self).__init__("too many requests for {}".format(key))
+        self.key = key
+        self.retry_after = retry_after
+
+
+class _Limit(object):
+    # token bucket and in-flight cap of one host or pattern. tokens are local, or leased
+    # from the shared bucket in redis and spent here until the lease runs out or expires
+    def __init__(self, key, rate, max_inflight):
+        self.key = key
+        self.rate = rate
+        self.burst = max(rate, 1)
+        self.max_inflight = max_inflight
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lease_expire = 0
+        self.waiters = 0
+        self.inflight = 0
+        self.semaphore = asyncio.Semaphore(max_inflight) if max_inflight else None
+
+    def take_local(self, cost, now):
+        # seconds to wait for cost tokens, 0 when they were taken
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    def idle(self, now):
+        # nothing waits on it or holds it, and a new one would start with the same tokens
+        if self.waiters or self.inflight:
+            return False
+        return not self.rate or self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class Limiter(object):
+    # token buckets in proxy requests per second and caps on requests in flight, per target host and per
+    # pattern. a request queues at most queue_timeout seconds, and is turned away at once when that will
+    # not do or max_queue requests are already waiting on the same key. in-flight caps are per process.
+    # past MAX_LIMITS keys the least recently used idle ones are dropped
+    KEY_PREFIX = 'rate_limit_'
+    MAX_LIMITS = 10000
+
+    def __init__(self, redis, host_rate=0, host_max_inflight=0, pattern_rate=0, pattern_max_inflight=0,
+                 queue_timeout=5, max_queue=100, shared=False, lease_size=10, lease_time=1):
+        self.redis = redis
+        self.host_rate = host_rate
+        self.host_max_inflight = host_max_inflight
+        self.pattern_rate = pattern_rate
+        self.pattern_max_inflight = pattern_max_inflight
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.shared = shared
+        self.lease_size = lease_size
+        self.lease_time = lease_time
+        self._limits = OrderedDict()
+
+    def _limit(self, key, rate, max_inflight):
+        limit = self._limits.get(key)
+        if limit is None or limit.rate != rate or limit.max_inflight != max_inflight:
+            # a changed setting starts over, requests holding the old one release it untouched
+            self._limits.pop(key, None)
+            self._evict()
+            limit = self._limits[key] = _Limit(key, rate, max_inflight)
+        self._limits.move_to_end(key)
+        return limit
+
+    def _evict(self):
+        # make room for one more, oldest first. busy ones are skipped and stay until a later call finds them idle
+        now = time.time()
+        excess = len(self._limits) + 1 - self.MAX_LIMITS
+        idle = list()
+        for key, limit in self._limits.items():
+            if len(idle) >= excess:
+                break
+            if limit.idle(now):
+                idle.append(key)
+        for key in idle:
+            del self._limits[key]
+
+    def limits(self, host, pattern):
+        # (key, rate, max_inflight) of the host and the pattern, a pattern's own settings come first
+        rate = self.pattern_rate if pattern.rate_limit is None else pattern.rate_limit
+        max_inflight = self.pattern_max_inflight if pattern.max_inflight is None else pattern.max_inflight
+        return [('host:' + host, self.host_rate, self.host_max_inflight),
+                ('pattern:' + str(pattern), rate, max_inflight)]
+
+    async def acquire(self, host, pattern, cost=1):
+        # cost is the number of proxy requests about to go out, returns what to hand to release()
+        deadline = time.time() + self.queue_timeout
+        acquired = list()
+        queued = False
+        try:
+            for key, rate, max_inflight in self.limits(host, pattern):
+                if not rate and not max_inflight:
+                    continue
+                limit = self._limit(key, rate, max_inflight)
+                queued = await self._acquire(limit, cost, deadline) or queued
+                acquired.append(limit)
+        except BaseException:
+            self.release(acquired)
+            raise
+        # admitted requests that had to wait, once however many limits held them up
+        if queued:
+            limit_stats['queued'] += 1
+        limit_stats['admitted'] += 1
+        return acquired
+
+    def release(self, acquired):
+        for limit in acquired:
+            if limit.semaphore is not None:
+                limit.inflight -= 1
+                limit.semaphore.release()
+
+    async def _acquire(self, limit, cost, deadline):
+        # True when the request had to wait
+        if limit.waiters >= self.max_queue:
+            self._reject(limit, self.queue_timeout)
+        limit.waiters += 1
+        queued = False
+        try:
+            if limit.semaphore is not None:
+                queued = limit.semaphore.locked()
+                if queued:
+                    try:
+                        await asyncio.wait_for(limit.semaphore.acquire(), max(deadline - time.time(), 0))
+                    except asyncio.TimeoutError:
+                        self._reject(limit, self.queue_timeout)
+                else:
+                    # a zero timeout would give up before even trying a free one
+                    await limit.semaphore.acquire()
+                limit.inflight += 1
+            try:
+                return await self._take(limit, min(cost, limit.burst), deadline) or queued
+            except BaseException:
+                if limit.semaphore is not None:
+                    limit.inflight -= 1
+                    limit.semaphore.release()
+                raise
+        finally:
+            limit.waiters -= 1
+
+    async def _take(self, limit, cost, deadline):
+        if not limit.rate:
+            return False
+        queued = False
+        while True:
+            now = time.time()
+            wait = await self._take_shared(limit, cost, now) if self.shared else limit.take_local(cost, now)
+            if wait == 0:
+                return queued
+            if now + wait > deadline:
+                self._reject(limit, wait)
+            queued = True
+            await asyncio.sleep(wait)
+
+    async def _take_shared(self, limit, cost, now):
+        # spend the local lease first, redis is only asked when it is used up or expired
+        if now >= limit.lease_expire:
+            limit.tokens = 0
+        if limit.tokens >= cost:
+            limit.tokens -= cost
+            return 0
+        need = cost - limit.tokens
+        try:
+            granted, wait = await lease_script(self.redis, [self.KEY_PREFIX + limit.key],
+                                               [int(now * 1000), limit.rate, limit.burst,
+                                                max(self.lease_size, need), need])
+        except Exception as e:
+            # redis trouble should not stop traffic, fall back to this process's bucket
+            logger.warning("unable to lease tokens for {}, {}".format(limit.key, e))
+            return limit.take_local(cost, now)
+        if not granted:
+            return wait / 1000
+        limit_stats['leases'] += 1
+        limit.tokens += granted - cost
+        limit.lease_expire = now + self.lease_time
+        return 0
+
+    @staticmethod
+    def _reject(limit, retry_after):
+        limit_stats['rejected'] += 1
+        raise RateLimited(limit.key, math.ceil(retry_after))
@@ -0,0 +1,187 @@
+import asyncio
+import bisect
+import time
+
+import aioredis
+from aioredis.abc import AbcConnection
+
+LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+WIDTH_BOUNDS = (1, 2, 3, 5, 10, 20, 50)
+
+
+class Histogram(object):
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+    def render(self, d, lines):
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        lines.append('# TYPE {} histogram'.format(self.name))
+        cumulative = 0
+        for bound, n in zip(self.bounds + ('+Inf',), d['counts']):
+            cumulative += n
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_sum {}'.format(self.name, d['sum']))
+        lines.append('{}_count {}'.format(self.name, d['count']))
+
+
+class Counter(object):
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def to_dict(self):
+        return self.value
+
+    def render(self, d, lines):
+        _render_value(self.name, self.help, 'counter', d, lines)
+
+
+def _render_value(name, help, kind, value, lines):
+    lines.append('# HELP {} {}'.format(name, help))
+    lines.append('# TYPE {} {}'.format(name, kind))
+    lines.append('{} {}'.format(name, value))
+
+
+forward_seconds = Histogram('proxy_tower_forward_seconds', 'Time to answer a forwarded request', LATENCY_BOUNDS)
+forward_failed = Counter('proxy_tower_forward_failed_total', 'Forwarded requests without a valid response')
+upstream_seconds = Histogram('proxy_tower_upstream_seconds', 'Time of single requests through a proxy',
+                             LATENCY_BOUNDS)
+check_seconds = Histogram('proxy_tower_check_seconds', 'Time spent checking a response', FAST_BOUNDS)
+redis_seconds = Histogram('proxy_tower_redis_seconds', 'Time of single redis commands', FAST_BOUNDS)
+select_seconds = Histogram('proxy_tower_select_seconds', 'Time spent in select_proxies', FAST_BOUNDS)
+fanout_width = Histogram('proxy_tower_fanout_width', 'Proxies actually requested per crawl', WIDTH_BOUNDS)
+cancelled = Counter('proxy_tower_cancelled_total', 'Proxy requests cancelled because another one won')
+loop_lag_seconds = Histogram('proxy_tower_loop_lag_seconds', 'Event loop lag sampled by a timer', FAST_BOUNDS)
+registry = [forward_seconds, forward_failed, upstream_seconds, check_seconds, redis_seconds, select_seconds,
+            fanout_width, cancelled, loop_lag_seconds]
+
+
+def snapshot():
+    return {metric.name: metric.to_dict() for metric in registry}
+
+
+class InstrumentedRedis(aioredis.Redis):
+    # times every command sent through execute. commands buffered by MULTI/EXEC or a pipeline only
+    # go out with the batch, they are handed back untimed
+
+    def execute(self, command, *args, **kwargs):
+        fut = super(InstrumentedRedis, self).execute(command, *args, **kwargs)
+        if not isinstance(self._pool_or_conn, AbcConnection):
+            return fut
+        return _timed(fut, time.time())
+
+
+async def _timed(fut, start):
+    try:
+        return await fut
+    finally:
+        redis_seconds.observe(time.time() - start)
+
+
+class LoopMonitor(object):
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            start = time.time()
+            await asyncio.sleep(self.INTERVAL)
+            loop_lag_seconds.observe(max(time.time() - start - self.INTERVAL, 0))
+
+
+def render(stats, pools=None, widths=None):
+    # stats is a (merged) cluster snapshot, pools maps pattern_str -> ProxyPool and widths
+    # pattern_str -> fan-out width of this process
+    lines = list()
+    for metric in registry:
+        if metric.name in stats['metrics']:
+            metric.render(stats['metrics'][metric.name], lines)
+    _render_value('proxy_tower_requests_total', 'Proxy responses scored', 'counter', stats['total_count'], lines)
+    _render_value('proxy_tower_valid_requests_total', 'Proxy responses scored as valid', 'counter',
+                  stats['success_count'], lines)
+    for k, v in sorted(stats['fanout'].items()):
+        _render_value('proxy_tower_fanout_{}_total'.format(k), 'Fan-out {} count'.format(k), 'counter', v, lines)
+    for k, v in sorted(stats['tunnel'].items()):
+        kind = 'gauge' if k == 'active' else 'counter'
+        name = 'proxy_tower_tunnel_{}'.format(k) + ('' if kind == 'gauge' else '_total')
+        _render_value(name, 'CONNECT tunnel {}'.format(k), kind, v, lines)
+    for k, name in [('connections', 'proxy_tower_upstream_connections_total'),
+                    ('reused', 'proxy_tower_upstream_reused_connections_total'),
+                    ('connect_time', 'proxy_tower_upstream_connect_seconds_total')]:
+        _render_value(name, 'Upstream connection {}'.format(k), 'counter', stats['sessions'][k], lines)
+    for k, v in sorted(stats['cache'].items()):
+        kind = 'gauge' if k in ('entries', 'bytes') else 'counter'
+        name = 'proxy_tower_cache_{}'.format(k) + ('' if kind == 'gauge' else '_total')
+        _render_value(name, 'Response cache {}'.format(k), kind, v, lines)
+    for k, v in sorted(stats['flights'].items()):
+        _render_value('proxy_tower_coalesce_{}_total'.format(k), 'Coalesced request {}'.format(k), 'counter', v,
+                      lines)
+    for k, v in sorted(stats['limits'].items()):
+        _render_value('proxy_tower_limit_{}_total'.format(k), 'Rate limiter {}'.format(k), 'counter', v, lines)
+    _render_value('proxy_tower_saturated_proxies', 'Proxies at their in-flight or rate cap', 'gauge',
+                  stats['load']['saturated'], lines)
+    _render_value('proxy_tower_saturated_proxy_skips_total', 'Proxies left out of a selection for being at their cap',
+                  'counter', stats['load']['skipped'], lines)
+    lines.append('# HELP proxy_tower_proxy_inflight Requests in flight per proxy')
+    lines.append('# TYPE proxy_tower_proxy_inflight gauge')
+    for proxy_str, n in sorted(stats['load']['inflight'].items()):
+        lines.append('proxy_tower_proxy_inflight{{proxy="{}"}} {}'.format(proxy_str, n))
+    if widths:
+        lines.append('# HELP proxy_tower_pattern_fanout_width Fan-out width chosen for the pattern by this process')
+        lines.append('# TYPE proxy_tower_pattern_fanout_width gauge')
+        for pattern_str, width in sorted(widths.items()):
+            lines.append('proxy_tower_pattern_fanout_width{{pattern="{}"}} {}'.format(_escape(pattern_str), width))
+    if pools:
+        _render_proxies(pools, lines)
+    return '\n'.join(lines) + '\n'
+
+
+def _render_proxies(pools, lines):
+    # gauges from the latency stats of every cached proxy, these are per process
+    names = [('proxy_tower_proxy_latency_ewma_seconds', 'ewma'), ('proxy_tower_proxy_latency_p90_seconds', 'p90'),
+             ('proxy_tower_proxy_success_rate', 'success_rate')]
+    for name, key in names:
+        lines.append('# HELP {} Per proxy {} of this process'.format(name, key))
+        lines.append('# TYPE {} gauge'.format(name))
+        for pattern_str, pool in pools.items():
+            for proxy_str, proxy in pool.proxies.items():
+                if proxy.latency.count == 0:
+                    continue
+                value = proxy.latency.percentile(0.9) if key == 'p90' else getattr(proxy.latency, key)
+                lines.append('{}{{pattern="{}",proxy="{}"}} {}'.format(name, _escape(pattern_str), proxy_str, value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
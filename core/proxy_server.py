@@ -4,14 +4,21 @@ import psutil
 import aioredis
 from aiohttp import web
 import aiohttp_cors
+from multidict import CIMultiDict
 
 import log_utils
+from core.cache import ResponseCache
+from core.cluster import ClusterStats
+from core.coalesce import SingleFlight
+from core.limiter import Limiter
+from core.metrics import InstrumentedRedis, LoopMonitor
 from core.dashboard import dashboard
 from core.forwarder import forward
 from core.saver import Saver
-from core.crawler import crawl, init_session
-from models.pattern import Checker, PatternManager
-from models.proxy import ProxyManager
+from core.crawler import crawl, open_session_pool
+from models.pattern import CheckExecutor, Checker, PatternManager
+from models.proxy import ProxyCache, ProxyManager
+from models.request import RequestBody
 
 logger = log_utils.LogHandler('server', file=True)
 
@@ -41,37 +48,70 @@ class ProxyServer(web.Application):
                 expose_headers="*",
                 allow_headers="*",)
         })
-        resource = cors.add(self.router.add_resource('/{path:.*}'))
+        # only the dashboard api needs cors, which answers OPTIONS there by itself
+        resource = cors.add(self.router.add_resource('/prod-api/{path:.*}'))
         cors.add(resource.add_route("GET", self.receive_request))
         cors.add(resource.add_route("POST", self.receive_request))
         cors.add(resource.add_route("DELETE", self.receive_request))
+        resource.add_route("*", self.receive_request)
+        self.router.add_route("*", '/{path:.*}', self.receive_request)
 
     async def core_session(self, app):
-        app['ips'] = await _get_self_ips()
         app['config'] = self._config
+        # before anything crawls, the self ip lookup included
+        app['sessions'] = open_session_pool(app['config'].proxy_conn_limit, app['config'].proxy_conn_limit_per_host,
+                                            app['config'].keepalive_timeout)
+        app['ips'] = await _get_self_ips()
         app['redis'] = await aioredis.create_redis_pool(app['config'].redis_addr,
                                                         password=app['config'].redis_password,
-                                                        encoding='utf8')
-        checker = Checker(global_blacklist=app['config'].global_blacklist)
-        saver = Saver(app['redis'])
+                                                        encoding='utf8', commands_factory=InstrumentedRedis)
+        executor = None
+        if app['config'].check_executor:
+            executor = CheckExecutor(app['config'].check_executor, app['config'].check_workers,
+                                     app['config'].check_inline_size, app['config'].check_max_pending)
+        checker = Checker(global_blacklist=app['config'].global_blacklist, executor=executor)
+        cache = ProxyCache(app['redis'])
+        saver = Saver(app['redis'], cache)
         proxy_manager = ProxyManager(
             config=app['config'],
-            redis=app['redis']
+            redis=app['redis'],
+            cache=cache
         )
         pattern_manager = PatternManager(checker, saver, app['redis'])
 
+        await saver.__aenter__()
         await pattern_manager.__aenter__()
+        await proxy_manager.migrate_records([str(p) for p in await pattern_manager.patterns()])
         await proxy_manager.__aenter__()
+        cluster = ClusterStats(app['redis'], saver, pattern_manager, app['config'].workers)
+        await cluster.__aenter__()
+        app['cluster'] = cluster
+        app['loop_monitor'] = await LoopMonitor().__aenter__()
+        app['cache'] = ResponseCache(app['redis'], app['config'].cache_max_bytes, app['config'].cache_ttl,
+                                     app['config'].cache_max_body_size, app['config'].cache_vary_headers,
+                                     app['config'].cache_shared)
+        app['flights'] = None
+        if app['config'].coalesce:
+            app['flights'] = SingleFlight(app['config'].coalesce_max_waiters)
+        app['limiter'] = Limiter(app['redis'], app['config'].host_rate_limit, app['config'].host_max_inflight,
+                                 app['config'].pattern_rate_limit, app['config'].pattern_max_inflight,
+                                 app['config'].limit_queue_timeout, app['config'].limit_max_queue,
+                                 app['config'].limit_shared, app['config'].limit_lease)
         app['pom'] = proxy_manager
         app['pam'] = pattern_manager
         app['ck'] = checker
         app['sv'] = saver
-        app['client_session'] = init_session()
         yield
+        await app['loop_monitor'].__aexit__(None, None, None)
+        await app['cluster'].__aexit__(None, None, None)
         await app['pam'].__aexit__(None, None, None)
         await app['pom'].__aexit__(None, None, None)
-        await app['client_session'].close()
-        await app['redis'].close()
+        await app['sv'].__aexit__(None, None, None)
+        await app['sessions'].close()
+        if app['ck'].executor is not None:
+            app['ck'].executor.shutdown()
+        app['redis'].close()
+        await app['redis'].wait_closed()
 
     async def receive_request(self, request):
         if request.url.host in request.app['ips']:
@@ -81,7 +121,19 @@ class ProxyServer(web.Application):
 
     async def forward_request(self, request):
         logger.info('received request {} from {}'.format(request.url, request.remote))
-        body = await request.content.read()
-        return await forward(request.method, str(request.url), request.app['pam'], request.app['pom'],
-                             headers=request.headers, body=body, mode=request.app['config'].mode,
-                             session=request.app['client_session'])
+        headers = CIMultiDict(request.headers)
+        body = None
+        if request.body_exists:
+            body = await RequestBody.read(request.content, request.app['config'].body_spool_size)
+            # the body is replayed with a known length whatever the client sent
+            headers.pop('Transfer-Encoding', None)
+            headers['Content-Length'] = str(len(body))
+        try:
+            return await forward(request.method, str(request.url), request.app['pam'], request.app['pom'],
+                                 headers=headers, body=body, mode=request.app['config'].mode,
+                                 stream=request.app['config'].stream, hedge=request.app['config'].hedge,
+                                 cache=request.app['cache'], flights=request.app['flights'],
+                                 limiter=request.app['limiter'])
+        finally:
+            if body is not None:
+                body.close()
@@ -1,60 +1,212 @@
 import asyncio
+import random
 import time
 from collections import defaultdict
 
+import log_utils
+from config import conf
+from core.script import Script
 from models.proxy import Proxy
 
+logger = log_utils.LogHandler(__name__, file=True)
+
+# KEYS: pattern, pattern_fail, pattern_version
+# ARGV: now, is_public, then (proxy_str, outcomes) pairs where outcomes is a string of 1/0
+# records follow Proxy.RECORD_FIELDS: score|used|valid_time|insert_time|paid|support_https|delete_time|tag
+SCORE_SCRIPT = """
+local function flag(v)
+    if v == true then return '1' elseif v == false then return '0' end
+    return ''
+end
+local function num(v)
+    if type(v) == 'number' then return string.format('%d', v) end
+    return ''
+end
+local function decode(j)
+    local f = {}
+    if string.sub(j, 1, 1) == '{' then
+        local d = cjson.decode(j)
+        local tag = d['tag']
+        if type(tag) ~= 'string' then tag = '' end
+        return {num(d['score']), flag(d['used']), num(d['valid_time']), num(d['insert_time']),
+                flag(d['paid']), flag(d['support_https']), num(d['delete_time']), tag}
+    end
+    local start = 1
+    for i = 1, 7 do
+        local stop = string.find(j, '|', start, true)
+        f[i] = string.sub(j, start, stop - 1)
+        start = stop + 1
+    end
+    f[8] = string.sub(j, start)
+    return f
+end
+
+local now = tonumber(ARGV[1])
+local is_public = ARGV[2] == '1'
+local result = {}
+for i = 3, #ARGV, 2 do
+    local proxy_str, outcomes = ARGV[i], ARGV[i + 1]
+    local j = redis.call('HGET', KEYS[1], proxy_str)
+    local stored = ''
+    if j then
+        local f = decode(j)
+        local score = tonumber(f[1]) or 0
+        local valid_time = tonumber(f[3]) or -1
+        local insert_time = tonumber(f[4]) or now
+        local deleted = false
+        for k = 1, #outcomes do
+            if string.sub(outcomes, k, k) == '1' then
+                if score < 0 then
+                    score = 0
+                elseif score < 5 then
+                    score = score + 1
+                end
+            else
+                score = score - 1
+                local remain_time = insert_time + valid_time - now
+                if (score <= -3 or (remain_time < 0 and valid_time > 0)) and not is_public then
+                    f[1] = string.format('%d', score)
+                    f[7] = string.format('%d', now)
+                    redis.call('HDEL', KEYS[1], proxy_str)
+                    redis.call('HSET', KEYS[2], proxy_str, table.concat(f, '|'))
+                    deleted = true
+                    break
+                end
+            end
+            f[2] = '1'
+        end
+        if not deleted then
+            f[1] = string.format('%d', score)
+            stored = table.concat(f, '|')
+            redis.call('HSET', KEYS[1], proxy_str, stored)
+        end
+    end
+    table.insert(result, proxy_str)
+    table.insert(result, stored)
+end
+table.insert(result, 1, redis.call('INCR', KEYS[3]))
+return result
+"""
+score_script = Script(SCORE_SCRIPT)
+
 
 class Saver(object):
     RESULT_SAVE_NUM = 100
-    pattern_lock_map = defaultdict(asyncio.Lock)
+    FLUSH_INTERVAL = 0.5
+    FLUSH_SIZE = 1000
     success_count = 0
     total_count = 0
 
-    def __init__(self, redis):
+    def __init__(self, redis, cache):
         self.redis = redis
+        self.cache = cache
+        self._outcomes = defaultdict(list)
+        self._flush_event = asyncio.Event()
+        self._flush_task = None
+        self._closing = False
 
-    async def _save(self, key, response):
+    async def __aenter__(self):
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # let a flush in progress finish instead of cancelling it half way, then write what is left
+        self._closing = True
+        self._flush_event.set()
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+
+    async def _save(self, key, info):
         key += '_result'
-        if hasattr(response, 'info_json'):
-            info = await response.info_json()
-            await asyncio.gather(*[self.redis.lpush(key, info),
-                                   self.redis.ltrim(key, 0, self.RESULT_SAVE_NUM - 1)])
+        await asyncio.gather(*[self.redis.lpush(key, info),
+                               self.redis.ltrim(key, 0, self.RESULT_SAVE_NUM - 1)])
+
+    @staticmethod
+    def _apply_score(proxy, valid, pattern_str):
+        # mirrors SCORE_SCRIPT, returns True when the proxy should be moved to <pattern>_fail
+        if valid:
+            if proxy.score < 0:
+                proxy.score = 0
+            elif 0 <= proxy.score < 5:
+                proxy.score += 1
+        else:
+            proxy.score -= 1
+            remain_time = proxy.insert_time + proxy.valid_time - int(time.time())
+            if (proxy.score <= -3 or (remain_time < 0 < proxy.valid_time)) and pattern_str != 'public_proxies':
+                return True
+        proxy.used = True
+        return False
 
     async def _score_counter(self, pattern_str, proxy_str, valid):
-        async with self.pattern_lock_map[pattern_str]:
-            proxy = await Proxy.discard(pattern_str, proxy_str, self.redis)
-            if proxy is None:
-                return
-
-            self.total_count += 1
-            if valid:
-                if proxy.score < 0:
-                    proxy.score = 0
-                elif 0 <= proxy.score < 5:
-                    proxy.score += 1
-                self.success_count += 1
-            else:
-                proxy.score -= 1
-                remain_time = proxy.insert_time + proxy.valid_time - int(time.time())
-                if (proxy.score <= -3 or (remain_time < 0 < proxy.valid_time)) and pattern_str != 'public_proxies':
-                    await self._del_proxy_in_pattern(pattern_str, proxy)
-                    return
+        pool = await self.cache.pool(pattern_str)
+        proxy = pool.get(proxy_str)
+        if proxy is None:
+            return
+
+        self.total_count += 1
+        if valid:
+            self.success_count += 1
+        # update the cached copy right away so selection sees it, redis catches up on flush
+        if self._apply_score(proxy, valid, pattern_str):
+            pool.remove(proxy_str)
+        else:
+            pool.put(proxy)
+        self._outcomes[(pattern_str, proxy_str)].append('1' if valid else '0')
+        if len(self._outcomes) >= self.FLUSH_SIZE:
+            self._flush_event.set()
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning("unable to flush proxy scores, {}".format(e), exc_info=True)
 
-            proxy.used = True
-            await proxy.store(pattern_str, self.redis)
+    async def flush(self):
+        if not self._outcomes:
+            return
+        outcomes, self._outcomes = self._outcomes, defaultdict(list)
+        batches = defaultdict(list)
+        for (pattern_str, proxy_str), results in outcomes.items():
+            batches[pattern_str].extend([proxy_str, ''.join(results)])
+        results = await asyncio.gather(*[self._flush_pattern(pattern_str, args)
+                                         for pattern_str, args in batches.items()], return_exceptions=True)
+        errors = list()
+        for (pattern_str, args), result in zip(batches.items(), results):
+            if isinstance(result, Exception):
+                # keep the outcomes of a pattern that failed to flush for the next round
+                for proxy_str in args[::2]:
+                    self._outcomes[(pattern_str, proxy_str)][:0] = outcomes[(pattern_str, proxy_str)]
+                errors.append(result)
+        if errors:
+            raise errors[0]
+
+    async def _flush_pattern(self, pattern_str, args):
+        keys = [pattern_str, pattern_str + '_fail', self.cache.version_key(pattern_str)]
+        is_public = '1' if pattern_str == 'public_proxies' else '0'
+        result = await score_script(self.redis, keys, [int(time.time()), is_public] + args)
+        version, put, remove = result[0], list(), list()
+        for proxy_str, j in zip(result[1::2], result[2::2]):
+            if j:
+                put.append(Proxy.loads(j, proxy_str))
+            else:
+                remove.append(proxy_str)
+        self.cache.apply(pattern_str, version, put=put, remove=remove)
 
     async def save_result(self, pattern_str, proxy_str, response):
         tasks = [
             self._score_counter(pattern_str, proxy_str, response.valid),
         ]
-        if not response.valid:
-            tasks.append(self._save(proxy_str, response))
-            tasks.append(self._save(pattern_str, response))
+        if not response.valid and hasattr(response, 'info_json'):
+            # page text and full tracebacks are only kept for a sample of the failures
+            with_text = random.random() < conf.failure_sample_rate
+            info = await response.info_json(with_text=with_text, max_size=conf.failure_text_size)
+            tasks.append(self._save(proxy_str, info))
+            tasks.append(self._save(pattern_str, info))
         await asyncio.gather(*tasks)
-
-    async def _del_proxy_in_pattern(self, pattern_str, proxy):
-        fail_key = pattern_str + '_fail'
-        proxy.delete_time = int(time.time())
-        await asyncio.gather(*[self.redis.hdel(pattern_str, str(proxy)),
-                               proxy.store(fail_key, self.redis)])
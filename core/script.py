@@ -0,0 +1,23 @@
+import hashlib
+
+from aioredis import ReplyError
+
+
+class Script(object):
+    # a lua script sent in full once, EVAL caches it in redis and later runs only send its sha
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+        self._cached = False
+
+    async def __call__(self, redis, keys=(), args=()):
+        if self._cached:
+            try:
+                return await redis.evalsha(self.sha, keys=list(keys), args=list(args))
+            except ReplyError as e:
+                # redis restarted or flushed its scripts since
+                if not str(e).startswith('NOSCRIPT'):
+                    raise
+        result = await redis.eval(self.source, keys=list(keys), args=list(args))
+        self._cached = True
+        return result
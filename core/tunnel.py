@@ -0,0 +1,227 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+import log_utils
+from config import conf
+from core.crawler import race
+from models.response import Failure, Failures
+
+logger = log_utils.LogHandler('server', file=True)
+
+tunnel_stats = {'requests': 0, 'established': 0, 'failed': 0, 'active': 0, 'bytes_sent': 0, 'bytes_received': 0}
+
+
+class TunnelResponse(Failures):
+    # outcome of a CONNECT through one upstream proxy, shaped like a Response for race() and the saver
+    cancelled = False
+    valid = False
+    status = None
+    elapsed = None
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.reader = None
+        self.writer = None
+
+    def release(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def _handshake(r, host, port):
+    r.reader, r.writer = await asyncio.open_connection(r.proxy.ip, r.proxy.port)
+    r.writer.write('CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n'.format(host, port).encode())
+    head = await r.reader.readuntil(b'\r\n\r\n')
+    r.status = int(head.split(b' ', 2)[1])
+
+
+async def _connect(host, port, proxy, pattern):
+    r = TunnelResponse(proxy)
+    start = time.time()
+    try:
+        await asyncio.wait_for(_handshake(r, host, port), conf.timeout)
+        r.valid = r.status == 200
+        if not r.valid:
+            r.add_failure(Failure(proxy, 'tunnel_status', 'CONNECT {}:{} failed, get {}'.format(host, port, r.status)))
+    except asyncio.CancelledError:
+        r.release()
+        r.cancelled = True
+        return r
+    except Exception as e:
+        r.add_failure(Failure.from_exception(proxy, e))
+    r.elapsed = time.time() - start
+    if not r.valid:
+        r.release()
+    try:
+        await pattern.score_and_save(r)
+    except asyncio.CancelledError:
+        r.release()
+        raise
+    return r
+
+
+async def _pipe(reader, writer, counts, counter):
+    while True:
+        data = await reader.read(64 * 1024)
+        if not data:
+            break
+        counts[counter] += len(data)
+        tunnel_stats[counter] += len(data)
+        writer.write(data)
+        await writer.drain()
+    if writer.can_write_eof():
+        writer.write_eof()
+
+
+def _parse_target(head):
+    target = head.split(b'\r\n', 1)[0].split(b' ')[1].decode()
+    host, _, port = target.rpartition(':')
+    if not host:
+        return target, 443
+    return host.strip('[]'), int(port)
+
+
+async def _reject(writer, status, text):
+    body = text.encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Length: {}\r\n'
+                 'Content-Type: text/plain; charset=utf-8\r\n\r\n'.format(status, len(body)).encode() + body)
+    await writer.drain()
+    writer.close()
+
+
+async def tunnel(app, reader, writer, head):
+    host, port = _parse_target(head)
+    if port not in app['config'].connect_ports:
+        # anything else would make this an open relay to any service, this server's redis included
+        logger.warning("refused a tunnel to {}:{}, port not allowed".format(host, port))
+        await _reject(writer, '403 Forbidden', 'CONNECT to port {} is not allowed'.format(port))
+        return
+    pam, pom = app['pam'], app['pom']
+    url = 'https://{}/'.format(host if port == 443 else '{}:{}'.format(host, port))
+    pattern_str, _ = pam.t.closest_pattern(url)
+    pattern = pam.get_pattern(pattern_str)
+    proxies = await pom.select_proxies(pattern_str, need_https=True, prefer_used=True, mode=app['config'].mode,
+                                       concurrent=pattern.fanout_width())
+    tunnel_stats['requests'] += 1
+    if len(proxies) == 0:
+        # never open the tunnel from this server's own address
+        tunnel_stats['failed'] += 1
+        logger.warning("no https proxy to open a tunnel to {}:{}".format(host, port))
+        await _reject(writer, '503 Service Unavailable', 'no https proxy available for {}'.format(pattern_str))
+        return
+
+    start = time.time()
+    r = await race(lambda proxy: _connect(host, port, proxy, pattern), proxies,
+                   hedge=app['config'].hedge, window='CONNECT ' + pattern_str)
+    if r is None or not r.valid:
+        pattern.counter(False)
+        tunnel_stats['failed'] += 1
+        text = 'unable to get any response' if r is None or r.traceback is None else r.traceback
+        logger.warning("unable to open a tunnel to {}:{}".format(host, port))
+        await _reject(writer, '417 Expectation Failed', text)
+        return
+    pattern.counter(True)
+    tunnel_stats['established'] += 1
+    tunnel_stats['active'] += 1
+    handshake_time = time.time() - start
+    counts = {'bytes_sent': 0, 'bytes_received': 0}
+    try:
+        writer.write('HTTP/1.1 200 Connection established\r\nVia-Proxy: {}\r\n\r\n'.format(r.proxy).encode())
+        pipes = [asyncio.ensure_future(_pipe(reader, r.writer, counts, 'bytes_sent')),
+                 asyncio.ensure_future(_pipe(r.reader, writer, counts, 'bytes_received'))]
+        try:
+            done, _ = await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+            if pipes[1] not in done and pipes[0].exception() is None:
+                # the client only half-closed, let the rest of the upstream data through
+                await asyncio.wait([pipes[1]])
+        finally:
+            for p in pipes:
+                p.cancel()
+    finally:
+        tunnel_stats['active'] -= 1
+        r.release()
+        writer.close()
+        logger.info("tunnel to {}:{} via proxy {} closed, handshake {:.3f}s, open {:.3f}s, "
+                    "{} bytes sent, {} bytes received".format(host, port, r.proxy, handshake_time,
+                                                             time.time() - start, counts['bytes_sent'],
+                                                             counts['bytes_received']))
+
+
+class EntranceProtocol(asyncio.Protocol):
+    # peeks at the first bytes of a connection: CONNECT requests become tunnels,
+    # everything else is handed over to the aiohttp request handler untouched
+    MAX_HEAD_SIZE = 64 * 1024
+    tunnels = set()
+
+    def __init__(self, http_factory, app):
+        self.http_factory = http_factory
+        self.app = app
+        self.transport = None
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if len(self.buffer) < 8 and b'CONNECT '.startswith(self.buffer):
+            return
+        if not self.buffer.startswith(b'CONNECT '):
+            self._switch(self.http_factory())
+            return
+        end = self.buffer.find(b'\r\n\r\n')
+        if end == -1:
+            if len(self.buffer) > self.MAX_HEAD_SIZE:
+                self.transport.close()
+            return
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        head, self.buffer = self.buffer[:end + 4], self.buffer[end + 4:]
+        writer = asyncio.StreamWriter(self.transport, protocol, reader, asyncio.get_event_loop())
+        self._switch(protocol)
+        task = asyncio.ensure_future(self._tunnel(reader, writer, head))
+        self.tunnels.add(task)
+        task.add_done_callback(self.tunnels.discard)
+
+    def _switch(self, protocol):
+        self.transport.set_protocol(protocol)
+        protocol.connection_made(self.transport)
+        if self.buffer:
+            protocol.data_received(self.buffer)
+        self.buffer = b''
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    async def _tunnel(self, reader, writer, head):
+        try:
+            await tunnel(self.app, reader, writer, head)
+        except asyncio.CancelledError:
+            writer.close()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            writer.close()
+
+
+def run_app(app, port, reuse_port=False):
+    # web.run_app, with EntranceProtocol in front of the aiohttp server
+    loop = asyncio.get_event_loop()
+    runner = web.AppRunner(app, handle_signals=True)
+    loop.run_until_complete(runner.setup())
+    server = loop.run_until_complete(loop.create_server(lambda: EntranceProtocol(runner.server, app),
+                                                        port=port, reuse_port=reuse_port or None))
+    logger.info("running on http://0.0.0.0:{}, CONNECT tunnels enabled".format(port))
+    try:
+        loop.run_forever()
+    except (web.GracefulExit, KeyboardInterrupt):
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        for task in list(EntranceProtocol.tunnels):
+            task.cancel()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
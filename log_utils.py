@@ -1,6 +1,12 @@
+import atexit
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import threading
+
+from config import conf
 
 CRITICAL = 50
 FATAL = CRITICAL
@@ -13,6 +19,176 @@ NOTSET = 0
 
 CURRENT_PATH = os.path.dirname(os.path.abspath(__file__))
 LOG_PATH = os.path.join(CURRENT_PATH, 'log')
+TEXT_FORMAT = '%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        d = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d['exc_info'] = record.exc_text
+        return json.dumps(d, ensure_ascii=False)
+
+
+def _formatter():
+    if conf.log_format == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+class RateLimitFilter(logging.Filter):
+    # lets through at most rate records per second from each call site, levels from ERROR up always pass.
+    # the next record let through from a call site tells how many were dropped
+    def __init__(self, rate):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self._windows = dict()
+
+    def filter(self, record):
+        if record.levelno >= ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        window = self._windows.get(key)
+        if window is None or window[0] != second:
+            suppressed = window[2] if window is not None else 0
+            window = self._windows[key] = [second, 0, 0]
+            if suppressed:
+                record.msg = '{} ({} similar messages suppressed)'.format(record.getMessage(), suppressed)
+                record.args = None
+        if window[1] >= self.rate:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+class _Listener(logging.handlers.QueueListener):
+    # writes each record to the targets of the handler that queued it, respecting their levels
+
+    def handle(self, record):
+        record = self.prepare(record)
+        for target in record.log_targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+
+class _LogQueue(object):
+    # one bounded queue and one QueueListener thread per process write the records of every LogHandler, so
+    # the event loop never waits on the disk. the listener starts on first use, and again in processes forked
+    # after it was started. records that do not fit are counted and reported once there is room again
+    MAX_QUEUE_SIZE = 100000
+
+    def __init__(self):
+        self.queue = None
+        self.listener = None
+        self.dropped = 0
+        self._dropped_targets = ()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self.queue = queue.Queue(self.MAX_QUEUE_SIZE)
+        self.listener = _Listener(self.queue)
+        self.listener.start()
+        self._pid = os.getpid()
+
+    def put(self, record, targets):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+        record.log_targets = targets
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._dropped_targets = targets
+            return
+        if self.dropped:
+            self._report_dropped()
+
+    def _report_dropped(self, timeout=None):
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+            targets = self._dropped_targets
+        if not dropped:
+            return
+        msg = '{} log records dropped, the log queue was full'.format(dropped)
+        record = logging.makeLogRecord({'name': 'log_utils', 'levelno': WARNING, 'levelname': 'WARNING', 'msg': msg,
+                                        'log_targets': targets})
+        try:
+            self.queue.put(record, block=timeout is not None, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += dropped
+
+    def stop(self):
+        if self._pid == os.getpid() and self.listener is not None:
+            self._report_dropped(timeout=5)
+            try:
+                self.listener.stop()
+            except queue.Full:
+                # no room for the stop sentinel, the listener thread is a daemon and goes down with the process
+                pass
+            self.listener = None
+            self._pid = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # hands records of the loggers writing to one set of targets to the log queue
+
+    def __init__(self, targets, log_queue):
+        super(_QueueHandler, self).__init__(None)
+        self.targets = targets
+        self.log_queue = log_queue
+
+    def prepare(self, record):
+        # render the message here, the arguments may change once the record leaves this thread.
+        # the record stays in this process, so exc_info is left for the targets' formatters
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self.log_queue.put(record, self.targets)
+
+
+_log_queue = _LogQueue()
+atexit.register(_log_queue.stop)
+# one queue handler per set of targets, shared by every LogHandler writing to them
+_queue_handlers = dict()
+
+
+def _queue_handler(targets):
+    handler = _queue_handlers.get(targets)
+    if handler is None:
+        handler = _queue_handlers[targets] = _QueueHandler(targets, _log_queue)
+    return handler
+
+
+# handlers are shared by every LogHandler writing to the same place, so a file is only opened and rotated once
+_handlers = dict()
+
+
+def _shared_handler(key, factory):
+    handler = _handlers.get(key)
+    if handler is None:
+        handler = _handlers[key] = factory()
+        handler.setFormatter(_formatter())
+    return handler
 
 
 class LogHandler(logging.Logger):
@@ -21,39 +197,58 @@ class LogHandler(logging.Logger):
         self.name = name
         self.level = level
         logging.Logger.__init__(self, self.name, level=level)
+        self._targets = list()
+        self._queue_handler = None
         if stream:
             self._set_stream_handler()
         if file:
             self._set_file_handler()
+        if conf.log_rate_limit:
+            self.addFilter(RateLimitFilter(conf.log_rate_limit))
+
+    def _add_target(self, handler):
+        if not conf.log_async:
+            self.addHandler(handler)
+            return
+        self._targets.append(handler)
+        self._set_queue_handler()
+
+    def _remove_target(self, handler):
+        if handler in self._targets:
+            self._targets.remove(handler)
+            self._set_queue_handler()
+        self.removeHandler(handler)
+
+    def _set_queue_handler(self):
+        if self._queue_handler is not None:
+            self.removeHandler(self._queue_handler)
+        self._queue_handler = _queue_handler(tuple(self._targets))
+        self.addHandler(self._queue_handler)
 
     def _set_file_handler(self, level=None):
         file_name = os.path.join(LOG_PATH, '{name}.log'.format(name=self.name))
-        file_handler = logging.handlers.TimedRotatingFileHandler(filename=file_name, when='D',
-                                                                 interval=1, backupCount=15)
-        file_handler.suffix = '%Y%m%d.log'
-        if not level:
-            file_handler.setLevel(self.level)
-        else:
-            file_handler.setLevel(level)
-        formatter = logging.Formatter('%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s')
-
-        file_handler.setFormatter(formatter)
-        self.file_handler = file_handler
-        self.addHandler(file_handler)
+
+        def factory():
+            file_handler = logging.handlers.TimedRotatingFileHandler(filename=file_name, when='D',
+                                                                     interval=1, backupCount=15)
+            file_handler.suffix = '%Y%m%d.log'
+            file_handler.setLevel(level or self.level)
+            return file_handler
+
+        self.file_handler = _shared_handler(file_name, factory)
+        self._add_target(self.file_handler)
 
     def _set_stream_handler(self, level=None):
-        stream_handler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s')
-        stream_handler.setFormatter(formatter)
-        if not level:
-            stream_handler.setLevel(self.level)
-        else:
-            stream_handler.setLevel(level)
-        self.addHandler(stream_handler)
+        def factory():
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(level or self.level)
+            return stream_handler
+
+        self._add_target(_shared_handler(('stream', level or self.level), factory))
 
     def reset_name(self, name):
         self.name = name
-        self.removeHandler(self.file_handler)
+        self._remove_target(self.file_handler)
         self._set_file_handler()
 
 
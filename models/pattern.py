@@ -1,116 +1,306 @@
 import asyncio
-import datetime
 import json
+import math
 import re
 import sys
+import threading
+import time
 import traceback
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from lxml import etree
-from pygtrie import CharTrie
 
-from models.response import FailedResponse
+from config import conf
+from core import metrics
+from models.response import FailedResponse, Failure
+from models.timeseries import TimeSeries
+
+
+class CheckFailure(str):
+    # the message of a failed check, code is the reason recorded for it and does not change with the wording
+
+    def __new__(cls, code, message):
+        failure = super(CheckFailure, cls).__new__(cls, message)
+        failure.code = code
+        return failure
+
+    def __reduce__(self):
+        # results of the process pool are pickled
+        return CheckFailure, (self.code, str(self))
 
 
 class Checker(object):
+    # a few words are found fastest with str.find, long lists with one alternation regex
+    REGEX_THRESHOLD = 8
 
-    def __init__(self, global_blacklist=None):
+    def __init__(self, global_blacklist=None, executor=None):
         self.global_blacklist = global_blacklist or list()
+        self.executor = executor
+        self._blacklist = {
+            str: self._compile_words(self.global_blacklist),
+            bytes: self._compile_words([word.encode('utf-8') for word in self.global_blacklist])
+        }
+
+    def _compile_words(self, words):
+        if len(words) > self.REGEX_THRESHOLD:
+            sep = b'|' if isinstance(words[0], bytes) else '|'
+            return words, re.compile(sep.join(re.escape(word) for word in words))
+        return words, None
 
     @staticmethod
     def _status_code_checker(status_code):
         return status_code is not None and (status_code == 404 or status_code < 400)
 
-    @staticmethod
-    def _xpath_checker(html, xpath, value):
-        try:
-            et = etree.HTML(html)
-            assert et.xpath(xpath)[0] == value
-        except IndexError:
-            return 'xpath check failed, {} not found'.format(xpath)
-        except AssertionError:
-            return 'xpath check failed, value not equal'
-        except Exception:
-            return ''.join(traceback.format_exception(*sys.exc_info()))
+    def blacklist_hit(self, body):
+        words, regex = self._blacklist[type(body)]
+        if regex is not None:
+            m = regex.search(body)
+            return m.group() if m else None
+        for word in words:
+            if word in body:
+                return word
+
+    def compile(self, rule, value):
+        return CompiledRule(self, rule, value)
 
     def check(self, status_code, text, rule, value):
-        if not self._status_code_checker(status_code):
-            return 'status_code check failed, get {}'.format(status_code)
-        for word in self.global_blacklist:
-            if word in text:
-                return 'global blacklist check failed, get {}'.format(word)
+        return self.compile(rule, value).check(status_code, text)
+
+    async def check_response(self, compiled, status_code, body, encoding):
+        reason, body = compiled.precheck(status_code, body, encoding)
+        if reason is not NEED_PARSE:
+            return reason
+        if self.executor is None:
+            return compiled.parse_check(body)
+        return await self.executor.parse_check(compiled, body)
+
+
+class CheckExecutor(object):
+
+    def __init__(self, kind='thread', workers=4, inline_size=64 * 1024, max_pending=64):
+        self.kind = kind
+        self.inline_size = inline_size
+        if kind == 'process':
+            self._executor = ProcessPoolExecutor(workers)
+        else:
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix='checker')
+        self._semaphore = asyncio.Semaphore(max_pending)
+
+    async def parse_check(self, compiled, body):
+        # small pages parse faster than a round trip to the pool
+        if len(body) < self.inline_size:
+            return compiled.parse_check(body)
+        async with self._semaphore:
+            loop = asyncio.get_event_loop()
+            if self.kind == 'process':
+                return await loop.run_in_executor(self._executor, _process_parse_check,
+                                                  compiled.rule, compiled.value, body)
+            return await loop.run_in_executor(self._executor, compiled.parse_check, body)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_process_rules = dict()
+
+
+def _process_parse_check(rule, value, body):
+    compiled = _process_rules.get((rule, value))
+    if compiled is None:
+        compiled = _process_rules[(rule, value)] = CompiledRule(Checker(), rule, value)
+    return compiled.parse_check(body)
+
+
+class CompiledRule(object):
+
+    def __init__(self, checker, rule, value):
+        self.checker = checker
+        self.rule = rule
+        self.value = value
+        self.xpath = None
+        self.error = None
+        self._local = threading.local()
         if rule == 'whitelist':
-            if value not in text:
-                return 'whitelist check failed, {} not found'.format(value)
+            self._value_bytes = (value or '').encode('utf-8')
         elif rule and value and len(rule.strip()) != 0 and len(value.strip()) != 0:
-            return self._xpath_checker(text, rule, value)
+            self._value_bytes = value.encode('utf-8')
+            try:
+                self.xpath = etree.XPath(rule)
+            except etree.XPathSyntaxError:
+                self.error = ''.join(traceback.format_exception(*sys.exc_info()))
+        # an xpath value can only be missing from the raw page if it was escaped in the markup. ascii letters,
+        # digits and spaces can only be escaped as &#...; anything else may also hide behind &eacute; or &nbsp;
+        self._prefilter = self.xpath is not None and not any(c in value for c in '&<>"\'')
+        self._char_ref = '&#' if self._prefilter and _PLAIN_VALUE.match(value) else '&'
+        self._char_ref_bytes = self._char_ref.encode()
+
+    def check(self, status_code, body, encoding='utf-8'):
+        reason, body = self.precheck(status_code, body, encoding)
+        if reason is NEED_PARSE:
+            return self.parse_check(body)
+        return reason
+
+    def precheck(self, status_code, body, encoding='utf-8'):
+        # everything short of parsing the page, returns NEED_PARSE when only the xpath is left.
+        # body is the page as str, or bytes in the given encoding, utf-8 bytes are searched as is
+        if not self.checker._status_code_checker(status_code):
+            return CheckFailure('status_code', 'status_code check failed, get {}'.format(status_code)), body
+        if isinstance(body, bytes) and encoding != 'utf-8':
+            body = body.decode(encoding, errors='replace')
+        is_bytes = isinstance(body, bytes)
+        word = self.checker.blacklist_hit(body)
+        if word is not None:
+            word = word.decode('utf-8') if is_bytes else word
+            return CheckFailure('global_blacklist', 'global blacklist check failed, get {}'.format(word)), body
+        if self.rule == 'whitelist':
+            if (self._value_bytes if is_bytes else self.value or '') not in body:
+                return CheckFailure('whitelist', 'whitelist check failed, {} not found'.format(self.value)), body
+        elif self.error is not None:
+            return CheckFailure('check_error', self.error), body
+        elif self.xpath is not None:
+            if self._prefilter:
+                value, char_ref = ((self._value_bytes, self._char_ref_bytes) if is_bytes
+                                   else (self.value, self._char_ref))
+                if value not in body and char_ref not in body:
+                    return CheckFailure('xpath', 'xpath check failed, {} not in page'.format(self.value)), body
+            return NEED_PARSE, body
+        return None, body
+
+    def _thread_xpath(self):
+        # xpath evaluators are not shared between threads
+        xpath = getattr(self._local, 'xpath', None)
+        if xpath is None:
+            xpath = self._local.xpath = etree.XPath(self.rule)
+        return xpath
+
+    def parse_check(self, body):
+        try:
+            et = etree.HTML(body, _utf8_parser()) if isinstance(body, bytes) else etree.HTML(body)
+            xpath = self.xpath if threading.current_thread() is threading.main_thread() else self._thread_xpath()
+            assert xpath(et)[0] == self.value
+        except IndexError:
+            return CheckFailure('xpath', 'xpath check failed, {} not found'.format(self.rule))
+        except AssertionError:
+            return CheckFailure('xpath', 'xpath check failed, value not equal')
+        except Exception:
+            return CheckFailure('check_error', ''.join(traceback.format_exception(*sys.exc_info())))
+
+
+NEED_PARSE = object()
+_PLAIN_VALUE = re.compile(r'^[A-Za-z0-9 ]*$')
+_parsers = threading.local()
+
+
+def _utf8_parser():
+    # lxml parsers must not be shared between threads
+    parser = getattr(_parsers, 'utf8', None)
+    if parser is None:
+        parser = _parsers.utf8 = etree.HTMLParser(encoding='utf-8')
+    return parser
+
+
+class FanoutController(object):
+    # the smallest fan-out width w with 1 - (1 - p) ** w >= target, p being the share of proxy attempts
+    # in the last window seconds that gave a valid response within the latency target. a prior of one
+    # success and one failure keeps p off 0 and 1 while there are few samples
+    def __init__(self, window):
+        self.good = TimeSeries(1, window)
+        self.total = TimeSeries(1, window)
+        self._slot = None
+        self._success_rate = None
+
+    def record(self, valid, elapsed, latency_target, now=None):
+        self.total.add(now=now)
+        if valid and elapsed is not None and elapsed <= latency_target:
+            self.good.add(now=now)
+
+    def success_rate(self, now=None):
+        # summed at most once per second
+        slot = self.total.slot(now)
+        if slot != self._slot:
+            good = sum(self.good.window(self.good.size, now))
+            total = sum(self.total.window(self.total.size, now))
+            self._slot, self._success_rate = slot, (good + 1) / (total + 2)
+        return self._success_rate
+
+    def width(self, target, min_width, max_width, now=None):
+        # no width reaches a target of 1 or more, the widest allowed comes closest
+        if target >= 1:
+            return max_width
+        p = self.success_rate(now)
+        w = math.ceil(math.log(1 - target) / math.log(1 - p)) if p < 1 else 1
+        return min(max(w, min_width), max_width)
 
 
 class Pattern(object):
+    # optional per pattern settings kept in the pattern json, None falls back to config.py:
+    # cache_ttl and cache_size to conf.cache_ttl and conf.cache_max_body_size, min_concurrent and
+    # max_concurrent to conf.concurrent_min and conf.concurrent, rate_limit and max_inflight to
+    # conf.pattern_rate_limit and conf.pattern_max_inflight
+    SETTINGS = ('cache_ttl', 'cache_size', 'min_concurrent', 'max_concurrent', 'rate_limit', 'max_inflight')
 
-    def __init__(self, pattern_str, rule, value, checker, saver=None):
+    def __init__(self, pattern_str, rule, value, checker, saver=None, **settings):
         self._pattern_str = pattern_str
         self.checker = checker
         self.saver = saver
         self.rule = rule
         self.value = value
-        self.counter_lock = asyncio.Lock()
-        self.success_counter = OrderedDict()
-        self.fail_counter = OrderedDict()
+        for name in self.SETTINGS:
+            setattr(self, name, settings.get(name))
+        self.fanout = FanoutController(conf.concurrent_window)
+        self.compiled = checker.compile(rule, value)
+        # one success and one fail series per (resolution, retention) of conf.counter_series
+        self.success_series = [TimeSeries(resolution, retention) for resolution, retention in conf.counter_series]
+        self.fail_series = [TimeSeries(resolution, retention) for resolution, retention in conf.counter_series]
 
     def __str__(self):
         return self._pattern_str
 
-    @property
-    def success_rate(self):
-        x = list()
-        y = list()
-        for t in self.success_counter:
-            if t in self.fail_counter:
-                y.append((self.success_counter[t] / (self.fail_counter[t] + self.success_counter[t])) * 100)
-            else:
-                y.append(100)
-            x.append(t)
-        return [x, y]
+    def series(self, resolution):
+        for success, fail in zip(self.success_series, self.fail_series):
+            if success.resolution == resolution:
+                return success, fail
+        raise KeyError("no counter series with resolution {}".format(resolution))
 
     async def check(self, response):
-        if isinstance(response, FailedResponse):
-            tb = response.traceback
-        else:
-            rule, value = self.rule, self.value
-            text = await response.text()
-            reason = self.checker.check(response.status, text, rule, value)
-            tb = None
+        if not isinstance(response, FailedResponse):
+            start = time.time()
+            body, encoding = response.check_body()
+            reason = await self.checker.check_response(self.compiled, response.status, body, encoding)
+            metrics.check_seconds.observe(time.time() - start)
             if reason is not None:
-                tb = str(response.proxy) + '\n' + reason + '\n'
-        response.valid = tb is None
-        response.traceback = tb
+                response.add_failure(Failure(response.proxy, reason.code, str(reason)))
+            response.valid = reason is None
         await self.score_and_save(response)
 
-    async def counter(self, valid):
-        now = datetime.datetime.now().strftime("%H:%M")
-        async with self.counter_lock:
-            c = self.success_counter if valid else self.fail_counter
-            if now in c:
-                c[now] += 1
-            else:
-                c[now] = 1
-            del_num = len(c) - 10
-            if del_num > 0:
-                for _ in range(del_num):
-                    c.popitem(last=False)
+    def counter(self, valid):
+        now = time.time()
+        for series in self.success_series if valid else self.fail_series:
+            series.add(now=now)
+
+    def fanout_width(self):
+        min_width = conf.concurrent_min if self.min_concurrent is None else self.min_concurrent
+        max_width = conf.concurrent if self.max_concurrent is None else self.max_concurrent
+        if not conf.adaptive_concurrent:
+            return max_width
+        return self.fanout.width(conf.concurrent_target, min_width, max_width)
 
     async def score_and_save(self, response):
+        self.fanout.record(response.valid, response.elapsed, conf.concurrent_latency_target or conf.timeout)
         if self.saver is None:
             return
         await self.saver.save_result(str(self), str(response.proxy), response)
 
     def to_dict(self):
-        return {
+        d = {
             'pattern': self._pattern_str,
             'rule': self.rule,
             'value': self.value
         }
+        for name in self.SETTINGS:
+            d[name] = getattr(self, name)
+        return d
 
     def dumps(self):
         return json.dumps(self.to_dict())
@@ -132,13 +322,38 @@ class PatternManager(object):
         self.saver = saver
         self._patterns = dict()
         self.key = 'response_check_pattern'
+        self.version_key = self.key + '_version'
+        self.version = 0
 
     async def __aenter__(self):
+        self.version = int(await self.redis.get(self.version_key) or 0)
         self.t = await self._init_trie()
         self._patterns = {str(pattern): pattern for pattern in await self.patterns()}
-        await self.add('public_proxies', None, None)
+        # keep the cache and other settings an operator gave it
+        if 'public_proxies' not in self._patterns:
+            await self.add('public_proxies', None, None)
         return self
 
+    async def refresh(self):
+        version = int(await self.redis.get(self.version_key) or 0)
+        if version == self.version:
+            return
+        self.version = version
+        self.t = await self._init_trie()
+        patterns = dict()
+        for pattern in await self.patterns():
+            # keep the counters of patterns that did not change
+            old = self._patterns.get(str(pattern))
+            if old is not None and old.to_dict() == pattern.to_dict():
+                pattern = old
+            patterns[str(pattern)] = pattern
+        self._patterns = patterns
+
+    async def _bump_version(self):
+        version = await self.redis.incr(self.version_key)
+        if version == self.version + 1:
+            self.version = version
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
 
@@ -153,7 +368,8 @@ class PatternManager(object):
                                 pattern['rule'],
                                 pattern['value'],
                                 self.checker,
-                                self.saver
+                                self.saver,
+                                **{name: pattern.get(name) for name in Pattern.SETTINGS}
                                 ) for pattern in patterns]
         return patterns
 
@@ -161,21 +377,35 @@ class PatternManager(object):
         if pattern_str in self._patterns:
             return self._patterns[pattern_str]
 
-    def status(self):
+    def counters(self, now=None):
+        # the status window of every pattern as {slot: count}, slots count from the epoch so workers can sum them
+        counters = dict()
+        for pattern in self._patterns.values():
+            success, fail = pattern.series(conf.status_resolution)
+            counters[str(pattern)] = {'success': success.to_dict(conf.status_points, now),
+                                      'fail': fail.to_dict(conf.status_points, now)}
+        return counters
+
+    def widths(self):
+        # the fan-out width every pattern would use now, per process
+        return {str(pattern): pattern.fanout_width() for pattern in self._patterns.values()}
+
+    def status(self, counters=None, now=None):
+        if now is None:
+            now = time.time()
+        if counters is None:
+            counters = self.counters(now)
+        resolution = conf.status_resolution
+        last = int(now // resolution)
+        slots = [str(slot) for slot in range(last - conf.status_points + 1, last + 1)]
+        time_format = '%H:%M' if resolution >= 60 else '%H:%M:%S'
+        x = [time.strftime(time_format, time.localtime(int(slot) * resolution)) for slot in slots]
         items = list()
-        now = datetime.datetime.now()
-        x = [(now - datetime.timedelta(minutes=i)).strftime("%H:%M") for i in range(9, -1, -1)]
-        patterns = self._patterns.values()
-        for pattern in patterns:
-            times, values = pattern.success_rate
-            y = [0] * 10
-            for i, t in enumerate(times):
-                try:
-                    ind = x.index(t)
-                except ValueError:
-                    pass
-                else:
-                    y[ind] = values[i]
+        for pattern, counter in counters.items():
+            y = list()
+            for slot in slots:
+                success, fail = counter['success'].get(slot, 0), counter['fail'].get(slot, 0)
+                y.append(success / (success + fail) * 100 if success + fail else 0)
             items.append({'pattern': str(pattern), 'serial': y})
         return x, items
 
@@ -186,42 +416,134 @@ class PatternManager(object):
     async def restore_trie(self, t):
         await self.redis.hmset(self.key, t)
 
-    async def add(self, pattern, rule, value):
-        p = Pattern(str(pattern), rule, value, self.checker, self.saver)
+    async def add(self, pattern, rule, value, **settings):
+        p = Pattern(str(pattern), rule, value, self.checker, self.saver, **settings)
         self._patterns[str(pattern)] = p
         self.t[str(pattern)] = p.dumps()
         await p.store(self.key, self.redis)
+        await self._bump_version()
 
     async def delete(self, pattern):
         del self.t[str(pattern)]
         del self._patterns[str(pattern)]
         await self.redis.hdel(self.key, str(pattern))
+        await self._bump_version()
 
-    async def update(self, pattern, rule, value):
-        await self.add(pattern, rule, value)
+    async def update(self, pattern, rule, value, **settings):
+        await self.add(pattern, rule, value, **settings)
 
     async def get_cookies(self, pattern_str):
         return await self.redis.srandmember(pattern_str + '_cookies')
 
 
-class CheckPatternTrie(CharTrie):
+class PrefixIndex(object):
+    # exact prefix dict probed with the distinct pattern lengths, longest first. pattern sets
+    # per host are small, so this is a handful of dict lookups instead of a trie walk
+
+    def __init__(self):
+        self._prefixes = dict()
+        self._lengths = list()
+
+    def __setitem__(self, key, value):
+        self._prefixes[key] = value
+        self._update_lengths()
+
+    def __delitem__(self, key):
+        del self._prefixes[key]
+        self._update_lengths()
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def _update_lengths(self):
+        self._lengths = sorted({len(k) for k in self._prefixes}, reverse=True)
+
+    @property
+    def max_length(self):
+        return self._lengths[0] if self._lengths else 0
+
+    def longest_prefix(self, s):
+        for n in self._lengths:
+            if n <= len(s):
+                prefix = s[:n]
+                if prefix in self._prefixes:
+                    return prefix, self._prefixes[prefix]
+        return None, None
+
+
+class CheckPatternTrie(object):
+    # patterns with a path are indexed by exact host first, so a lookup only probes the path part.
+    # patterns without a path may end in the middle of a host and are matched against the host.
+    # a url can only match on its first few characters, lookups are cached on that prefix
+    CACHE_SIZE = 10000
+    PUBLIC_RULE_JSON = json.dumps({'rule': None, 'value': None})
 
     def __init__(self, *args, **kwargs):
-        super(CheckPatternTrie, self).__init__(*args, **kwargs)
+        self._hosts = dict()
+        self._partial = PrefixIndex()
+        self._cache = OrderedDict()
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    @staticmethod
+    def _split(key):
+        slash = key.find('/')
+        if slash < 0:
+            return key, None
+        return key[:slash], key[slash:]
 
     def __setitem__(self, key, value):
-        super(CheckPatternTrie, self).__setitem__(self._remove_http_prefix(key), value)
+        host, path = self._split(self._remove_http_prefix(key))
+        if path is None:
+            self._partial[host] = value
+        else:
+            self._hosts.setdefault(host, PrefixIndex())[path] = value
+        self._cache.clear()
+
+    def __delitem__(self, key):
+        host, path = self._split(self._remove_http_prefix(key))
+        if path is None:
+            del self._partial[host]
+        else:
+            paths = self._hosts[host]
+            del paths[path]
+            if len(paths) == 0:
+                del self._hosts[host]
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._partial) + sum(len(paths) for paths in self._hosts.values())
 
     def closest_pattern(self, url):
         url = self._remove_http_prefix(url)
-        step = self.longest_prefix(url)
-        pattern_str, check_rule_json = step.key, step.value
+        host, path = self._split(url)
+        paths = self._hosts.get(host)
+        prefix = url[:max(len(host) + (paths.max_length if paths is not None else 0), self._partial.max_length)]
+        cached = self._cache.get(prefix)
+        if cached is not None:
+            self._cache.move_to_end(prefix)
+            return cached
+
+        pattern_str, check_rule_json = None, None
+        if paths is not None and path is not None:
+            key, value = paths.longest_prefix(path)
+            if key is not None:
+                pattern_str, check_rule_json = host + key, value
+        key, value = self._partial.longest_prefix(host)
+        if key is not None and (pattern_str is None or len(key) > len(pattern_str)):
+            pattern_str, check_rule_json = key, value
         if pattern_str is None:
-            pattern_str, check_rule_json = 'public_proxies', json.dumps({'rule': None, 'value': None})
+            pattern_str, check_rule_json = 'public_proxies', self.PUBLIC_RULE_JSON
+
+        self._cache[prefix] = pattern_str, check_rule_json
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
         return pattern_str, check_rule_json
 
     @staticmethod
     def _remove_http_prefix(url):
-        if url.startswith('http'):
-            url = re.sub(r'https?://', '', url, 1)
+        if url.startswith('http://'):
+            return url[7:]
+        if url.startswith('https://'):
+            return url[8:]
         return url
@@ -1,3 +1,5 @@
+import asyncio
+import bisect
 import heapq
 import json
 import random
@@ -7,14 +9,68 @@ import warnings
 from collections import defaultdict
 
 import log_utils
-from core.crawler import crawl
+from core import metrics
+from core.crawler import crawl, proxy_load
+from core.script import Script
 from models.response import FailedResponse
 
 logger = log_utils.LogHandler(__name__, file=True)
 
 
+class LatencyStats(object):
+    __slots__ = ('ewma', 'success_rate', 'count', 'histogram')
+    ALPHA = 0.2
+    # histogram bucket upper bounds in seconds, the last bucket is everything slower
+    BOUNDS = (0.1, 0.2, 0.5, 1, 2, 4, 8)
+
+    def __init__(self):
+        self.ewma = None
+        self.success_rate = None
+        self.count = 0
+        self.histogram = [0] * (len(self.BOUNDS) + 1)
+
+    def record(self, elapsed, valid):
+        self.count += 1
+        if self.ewma is None:
+            self.ewma, self.success_rate = elapsed, float(valid)
+        else:
+            self.ewma += self.ALPHA * (elapsed - self.ewma)
+            self.success_rate += self.ALPHA * (valid - self.success_rate)
+        self.histogram[bisect.bisect_left(self.BOUNDS, elapsed)] += 1
+
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            seen += n
+            if seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.BOUNDS[-1] * 2
+        return self.BOUNDS[-1] * 2
+
+    def expected_time(self, default_latency, default_success=0.5):
+        # expected wait for a valid response if the request were retried on this proxy until it succeeds
+        latency = default_latency if self.ewma is None else self.ewma
+        success_rate = default_success if self.success_rate is None else self.success_rate
+        return latency / max(success_rate, 0.01)
+
+    def to_dict(self):
+        return {
+            'ewma': None if self.ewma is None else round(self.ewma, 3),
+            'success_rate': None if self.success_rate is None else round(self.success_rate, 3),
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'count': self.count,
+            'histogram': dict(zip([str(b) for b in self.BOUNDS] + ['+Inf'], self.histogram))
+        }
+
+
 class Proxy(object):
-    _score = 0
+    __slots__ = ('ip', 'port', 'valid_time', 'insert_time', 'support_https', 'paid', 'tag', 'used',
+                 'delete_time', 'latency', '_score')
+    # compact record stored as the hash value, ip and port live in the hash field
+    RECORD_FIELDS = ('score', 'used', 'valid_time', 'insert_time', 'paid', 'support_https', 'delete_time', 'tag')
 
     def __init__(self, ip, port, **kwargs):
         self.ip = ip
@@ -24,7 +80,10 @@ class Proxy(object):
         self.support_https = kwargs.get('support_https', None)
         self.paid = kwargs.get('paid')
         self.tag = kwargs.get('tag')
+        self.delete_time = kwargs.get('delete_time')
         self.used = False
+        self.latency = LatencyStats()
+        self._score = 0
 
     @property
     def score(self):
@@ -37,7 +96,15 @@ class Proxy(object):
         self._score = value
 
     def dumps(self):
-        return json.dumps(self.to_dict())
+        return '|'.join(self._encode_field(getattr(self, field)) for field in self.RECORD_FIELDS)
+
+    @staticmethod
+    def _encode_field(value):
+        if value is None:
+            return ''
+        if value is True or value is False:
+            return '1' if value else '0'
+        return str(value)
 
     def to_dict(self):
         d = {
@@ -49,9 +116,12 @@ class Proxy(object):
             "insert_time": self.insert_time,
             "tag": self.tag,
             "paid": self.paid,
-            "support_https": self.support_https
+            "support_https": self.support_https,
+            "latency": self.latency.to_dict(),
+            "inflight": proxy_load.inflight.get(str(self), 0),
+            "requests_per_second": proxy_load.rate(str(self))
         }
-        if hasattr(self, 'delete_time'):
+        if self.delete_time is not None:
             d['delete_time'] = self.delete_time
         return d
 
@@ -66,14 +136,33 @@ class Proxy(object):
         j = await redis.hget(str(pattern_str), str(proxy_str))
         if j is None:
             return None
-        return cls.loads(j)
+        return cls.loads(j, proxy_str)
+
+    @staticmethod
+    def is_legacy(j):
+        return j.startswith('{')
 
     @classmethod
-    def loads(cls, j):
+    def loads(cls, j, proxy_str=None):
+        if cls.is_legacy(j):
+            return cls._loads_json(j)
+        flag = {'1': True, '0': False, '': None}
+        score, used, valid_time, insert_time, paid, support_https, delete_time, tag = j.split('|', 7)
+        proxy = cls.parse(proxy_str, valid_time=int(valid_time) if valid_time else None,
+                          insert_time=int(insert_time), tag=tag or None, support_https=flag[support_https],
+                          paid=flag[paid], delete_time=int(delete_time) if delete_time else None)
+        proxy.score = int(score)
+        proxy.used = bool(flag[used])
+        return proxy
+
+    @classmethod
+    def _loads_json(cls, j):
+        # records written before the compact format
         d = json.loads(j)
         proxy = Proxy(d['ip'], d['port'], valid_time=d.get('valid_time'),
                       insert_time=d['insert_time'], tag=d.get('tag'),
-                      support_https=d.get('support_https', False), paid=d.get('paid'))
+                      support_https=d.get('support_https', False), paid=d.get('paid'),
+                      delete_time=d.get('delete_time'))
         proxy.score = d['score']
         proxy.used = d['used']
         return proxy
@@ -86,56 +175,325 @@ class Proxy(object):
         return Proxy(ip, port, **kwargs)
 
 
+def prefer_used_selector(score, used, prefer_used=True):
+    if used and prefer_used and score > 0:
+        score *= 1.5
+    return score
+
+
+def _load(proxy):
+    return proxy_load.inflight.get(str(proxy), 0)
+
+
+def _first(proxies, k, skip):
+    # the first k proxies skip(proxy) keeps, the ones after them are never looked at
+    selected = list()
+    for proxy in proxies:
+        if len(selected) >= k:
+            break
+        if skip is None or not skip(proxy):
+            selected.append(proxy)
+    return selected
+
+
+class ScoreIndex(object):
+    # scores are small integers, so proxies are bucketed by (score, used) and top-k
+    # only has to sort the handful of buckets instead of the whole pool
+
+    def __init__(self, proxies=()):
+        self._buckets = defaultdict(dict)
+        self._keys = dict()
+        for proxy in proxies:
+            self.add(proxy)
+
+    def add(self, proxy):
+        proxy_str = str(proxy)
+        key = (proxy.score, proxy.used)
+        old_key = self._keys.get(proxy_str)
+        if old_key is not None and old_key != key:
+            self._discard(proxy_str, old_key)
+        self._buckets[key][proxy_str] = proxy
+        self._keys[proxy_str] = key
+
+    def remove(self, proxy_str):
+        key = self._keys.pop(proxy_str, None)
+        if key is not None:
+            self._discard(proxy_str, key)
+
+    def _discard(self, proxy_str, key):
+        bucket = self._buckets[key]
+        bucket.pop(proxy_str, None)
+        if not bucket:
+            del self._buckets[key]
+
+    def top(self, k, prefer_used=True, need_https=False, skip=None, load=None):
+        # skip(proxy) leaves a proxy out, with load(proxy) idle proxies of a bucket go first and busy ones
+        # follow, least loaded first. busy proxies are few, so buckets are still only scanned until k are found
+        selected = list()
+        if k <= 0:
+            return selected
+        keys = sorted(self._buckets, key=lambda b: prefer_used_selector(b[0], b[1], prefer_used), reverse=True)
+        for key in keys:
+            busy = list()
+            for proxy in self._buckets[key].values():
+                if need_https and not proxy.support_https:
+                    continue
+                if skip is not None and skip(proxy):
+                    continue
+                if load is not None and load(proxy):
+                    busy.append(proxy)
+                    continue
+                selected.append(proxy)
+                if len(selected) >= k:
+                    return selected
+            if busy:
+                busy.sort(key=load)
+                selected.extend(busy[:k - len(selected)])
+                if len(selected) >= k:
+                    return selected
+        return selected
+
+
+class ProxyPool(object):
+
+    def __init__(self, proxies=None, version=0):
+        self.proxies = proxies or dict()
+        self.index = ScoreIndex(self.proxies.values())
+        self.version = version
+        self.checked_at = time.time()
+
+    def put(self, proxy):
+        old = self.proxies.get(str(proxy))
+        if old is not None and old is not proxy:
+            # latency is only tracked in memory, keep it when the record is replaced
+            proxy.latency = old.latency
+        self.proxies[str(proxy)] = proxy
+        self.index.add(proxy)
+
+    def remove(self, proxy_str):
+        self.proxies.pop(str(proxy_str), None)
+        self.index.remove(str(proxy_str))
+
+    def get(self, proxy_str):
+        return self.proxies.get(str(proxy_str))
+
+    def __len__(self):
+        return len(self.proxies)
+
+
+class ProxyCache(object):
+    # every write to a pool bumps <pattern>_version in the same transaction, readers
+    # compare versions at most once per interval and reload only when someone else wrote
+    VERSION_CHECK_INTERVAL = 1
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._pools = dict()
+        self._load_lock_map = defaultdict(asyncio.Lock)
+
+    @staticmethod
+    def version_key(pattern_str):
+        return pattern_str + '_version'
+
+    async def pool(self, pattern_str):
+        pool = self._pools.get(pattern_str)
+        if pool is not None and time.time() - pool.checked_at < self.VERSION_CHECK_INTERVAL:
+            return pool
+        async with self._load_lock_map[pattern_str]:
+            pool = self._pools.get(pattern_str)
+            if pool is not None and time.time() - pool.checked_at < self.VERSION_CHECK_INTERVAL:
+                return pool
+            version = int(await self.redis.get(self.version_key(pattern_str)) or 0)
+            if pool is None or pool.version != version:
+                pool = await self._load(pattern_str)
+            pool.checked_at = time.time()
+            return pool
+
+    async def _load(self, pattern_str):
+        tr = self.redis.multi_exec()
+        tr.hgetall(pattern_str)
+        tr.get(self.version_key(pattern_str))
+        d, version = await tr.execute()
+        old_pool = self._pools.get(pattern_str)
+        pool = ProxyPool({k: Proxy.loads(v, k) for k, v in d.items()}, int(version or 0))
+        if old_pool is not None:
+            for proxy_str, proxy in pool.proxies.items():
+                old = old_pool.get(proxy_str)
+                if old is not None:
+                    proxy.latency = old.latency
+        self._pools[pattern_str] = pool
+        return pool
+
+    def loaded(self):
+        return dict(self._pools)
+
+    async def get(self, pattern_str, proxy_str):
+        pool = await self.pool(pattern_str)
+        return pool.get(proxy_str)
+
+    def apply(self, pattern_str, version, put=(), remove=()):
+        pool = self._pools.get(pattern_str)
+        if pool is None:
+            return
+        for proxy in put:
+            pool.put(proxy)
+        for proxy_str in remove:
+            pool.remove(proxy_str)
+        if pool.version + 1 == version:
+            pool.version = version
+        else:
+            # another writer got in between, force a reload on next access
+            pool.checked_at = 0
+
+    async def store(self, pattern_str, proxy):
+        tr = self.redis.multi_exec()
+        tr.hset(pattern_str, str(proxy), proxy.dumps())
+        tr.incr(self.version_key(pattern_str))
+        _, version = await tr.execute()
+        self.apply(pattern_str, version, put=[proxy])
+
+    async def clean(self, pattern_str):
+        tr = self.redis.multi_exec()
+        tr.delete(pattern_str)
+        tr.incr(self.version_key(pattern_str))
+        await tr.execute()
+        self._pools.pop(pattern_str, None)
+
+
+# KEYS: (pool, pool_fail, pool_version) for the pattern, then for public_proxies unless that is the pattern
+# ARGV: now, renew_time, limit (0 for none), then (proxy_str, record) pairs.
+# a proxy deleted from any of the pools less than renew_time ago is skipped, so is one already in the pattern,
+# the rest are written to every pool that does not have them yet, at most limit of them
+ADD_SCRIPT = """
+local function delete_time(j)
+    if string.sub(j, 1, 1) == '{' then
+        local t = cjson.decode(j)['delete_time']
+        if type(t) == 'number' then return t end
+        return 0
+    end
+    local start = 1
+    for i = 1, 6 do
+        start = string.find(j, '|', start, true) + 1
+    end
+    return tonumber(string.sub(j, start, string.find(j, '|', start, true) - 1)) or 0
+end
+
+local now, renew_time, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local pools = #KEYS / 3
+local added = {}
+for p = 1, pools do
+    added[p] = {}
+end
+local n = 0
+for i = 4, #ARGV, 2 do
+    if limit > 0 and n >= limit then
+        break
+    end
+    local proxy_str, record = ARGV[i], ARGV[i + 1]
+    local blocked = false
+    for p = 1, pools do
+        local j = redis.call('HGET', KEYS[3 * p - 1], proxy_str)
+        if j and now - delete_time(j) < renew_time then
+            blocked = true
+            break
+        end
+    end
+    if not blocked and redis.call('HEXISTS', KEYS[1], proxy_str) == 0 then
+        n = n + 1
+        for p = 1, pools do
+            redis.call('HDEL', KEYS[3 * p - 1], proxy_str)
+            if p == 1 or redis.call('HEXISTS', KEYS[3 * p - 2], proxy_str) == 0 then
+                redis.call('HSET', KEYS[3 * p - 2], proxy_str, record)
+                table.insert(added[p], proxy_str)
+            end
+        end
+    end
+end
+local result = {n}
+for p = 1, pools do
+    local version = 0
+    if #added[p] > 0 then
+        version = redis.call('INCR', KEYS[3 * p])
+    end
+    table.insert(result, version)
+    table.insert(result, added[p])
+end
+return result
+"""
+add_script = Script(ADD_SCRIPT)
+
+
 class ProxyManager(object):
     RENEW_TIME = 8 * 60 * 60
+    ADD_INTERVAL = 5
+    ADD_BATCH_SIZE = 1000
     _last_add_time = defaultdict(int)
 
-    def __init__(self, config, redis, tags_source_map=None):
+    def __init__(self, config, redis, tags_source_map=None, cache=None):
         self.config = config
         self.redis = redis
         self.tags_source_map = tags_source_map or dict()
+        self.cache = cache or ProxyCache(redis)
+        self._refill_tasks = dict()
+        self._fetching = None
 
     async def __aenter__(self):
         await self.add_proxies_for_pattern('public_proxies')
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        pass
+        for task in self._refill_tasks.values():
+            task.cancel()
 
     async def proxies(self, need_https=False, pattern_str='public_proxies', format_type='raw'):
-        d = await self.redis.hgetall(pattern_str)
-        proxies = [Proxy.loads(v) for _, v in d.items()]
+        pool = await self.cache.pool(pattern_str)
+        proxies = list(pool.proxies.values())
         if need_https:
             proxies = [p for p in proxies if p.support_https]
         if format_type == 'dict':
             proxies = [p.to_dict() for p in proxies]
         return proxies
 
-    async def clean_proxies(self, pattern_str='public_proxies'):
-        await self.redis.delete(pattern_str)
-
-    async def select_proxies(self, pattern_str, need_https=False, prefer_used=True, economic=True, mode='combine'):
-        proxies = await self.proxies(need_https, pattern_str)
-        concurrent_num = min(len(proxies), self.config.concurrent)
+    async def migrate_records(self, pattern_strs):
+        # rewrite json records left by older versions into the compact format
+        migrated_num = 0
+        for pattern_str in pattern_strs:
+            for key in (pattern_str, pattern_str + '_fail'):
+                d = await self.redis.hgetall(key)
+                legacy = {k: Proxy.loads(v, k).dumps() for k, v in d.items() if Proxy.is_legacy(v)}
+                if legacy:
+                    await self.redis.hmset_dict(key, legacy)
+                    migrated_num += len(legacy)
+        if migrated_num:
+            logger.info("{} proxy records migrated to compact format".format(migrated_num))
+        return migrated_num
 
-        def prefer_used_selector(proxy):
-            score, used = proxy.score, proxy.used
-            if used and prefer_used and score > 0:
-                score *= 1.5
-            return score
-        if mode == 'shuffle':
-            if prefer_used:
-                warnings.warn("prefer used won't take affect when shuffle mode is on")
-            selected_proxies = random.sample(proxies, concurrent_num)
-        elif mode == 'greedy':
-            selected_proxies = heapq.nlargest(concurrent_num, proxies, key=lambda a: prefer_used_selector(a))
-        else:
-            n = min(2*concurrent_num, len(proxies))
-            selected_proxies = random.sample(
-                heapq.nlargest(
-                    n, proxies, key=lambda a: prefer_used_selector(a)
-                ), concurrent_num
-            )
+    async def clean_proxies(self, pattern_str='public_proxies'):
+        await self.cache.clean(pattern_str)
+
+    async def select_proxies(self, pattern_str, need_https=False, prefer_used=True, economic=True, mode='combine',
+                             concurrent=None):
+        start = time.time()
+        concurrent = concurrent or self.config.concurrent
+        pool = await self.cache.pool(pattern_str)
+        self.replenish(pattern_str, len(pool))
+        saturated = list()
+
+        def skip(proxy):
+            if self._saturated(proxy):
+                saturated.append(str(proxy))
+                return True
+            return False
+        selected_proxies = self._select(pool, concurrent, need_https, prefer_used, mode, skip)
+        if not selected_proxies:
+            # every proxy is at its cap, the least busy ones still beat a direct request
+            selected_proxies = self._select(pool, concurrent, need_https, prefer_used, mode, None)
+        # saturated proxies that would have made the selection and did not
+        proxy_load.skipped += len(set(saturated) - {str(p) for p in selected_proxies})
+        if not selected_proxies and pattern_str != 'public_proxies':
+            # a new or drained pattern waits for its refill in the background, public proxies serve it meanwhile
+            public_pool = await self.cache.pool('public_proxies')
+            selected_proxies = self._select(public_pool, concurrent, need_https, prefer_used, mode, None)
         if economic:
             # put only one paid proxy in selected_proxies to avoid wasting
             already_put_one = False
@@ -147,62 +505,137 @@ class ProxyManager(object):
                     already_put_one = True
                 temp.append(p)
             selected_proxies = temp
+        metrics.select_seconds.observe(time.time() - start)
         return selected_proxies
 
+    def _saturated(self, proxy):
+        return proxy_load.saturated(str(proxy), self.config.proxy_max_inflight, self.config.proxy_max_rate)
+
+    @staticmethod
+    def _candidates(pool, need_https):
+        proxies = list(pool.proxies.values())
+        if need_https:
+            proxies = [p for p in proxies if p.support_https]
+        return proxies
+
+    def _select(self, pool, concurrent, need_https, prefer_used, mode, skip):
+        if mode == 'shuffle':
+            if prefer_used:
+                warnings.warn("prefer used won't take affect when shuffle mode is on")
+            proxies = self._candidates(pool, need_https)
+            random.shuffle(proxies)
+            selected_proxies = _first(proxies, concurrent, skip)
+        elif mode == 'latency':
+            proxies = self._candidates(pool, need_https)
+            # untried proxies rank as a 1/10 timeout, 50% proxy so they still get picked
+            default_latency = self.config.timeout / 10
+            heap = [(p.latency.expected_time(default_latency), i, p) for i, p in enumerate(proxies)]
+            heapq.heapify(heap)
+            # popped lazily, fastest first, so only as many are ordered as it takes to fill the selection
+            selected_proxies = _first((heapq.heappop(heap)[2] for _ in range(len(heap))), concurrent, skip)
+        elif mode == 'greedy':
+            selected_proxies = pool.index.top(concurrent, prefer_used, need_https, skip, _load)
+        else:
+            candidates = pool.index.top(2 * concurrent, prefer_used, need_https, skip, _load)
+            selected_proxies = random.sample(candidates, min(len(candidates), concurrent))
+            # best first, hedged fan-out starts them in this order
+            selected_proxies.sort(key=lambda p: (-prefer_used_selector(p.score, p.used, prefer_used), _load(p)))
+        return selected_proxies
+
+    def replenish(self, pattern_str, proxy_count):
+        # called on the request path, a pool under the low watermark is refilled by a background task,
+        # at most one per pattern at a time
+        if proxy_count >= self.config.pool_low_watermark:
+            return
+        task = self._refill_tasks.get(pattern_str)
+        if task is None or task.done():
+            self._refill_tasks[pattern_str] = asyncio.ensure_future(self._refill(pattern_str))
+
+    async def _refill(self, pattern_str):
+        try:
+            await self.add_proxies_for_pattern(pattern_str)
+        except Exception as e:
+            logger.warning("unable to refill proxies for {}, {}".format(pattern_str, e), exc_info=True)
+
     async def sync_public(self, pattern_str):
-        added_num = 0
         proxies = await self.proxies(pattern_str='public_proxies')
-        for proxy in proxies:
-            if await self._add_proxy(proxy, pattern_str):
-                added_num += 1
-        return added_num
+        return await self._add_proxies(proxies, pattern_str)
 
     async def add_proxies(self, pattern_str, num=30):
+        proxies = await self.fetch_proxies()
+        return await self._add_proxies(proxies, pattern_str, num)
+
+    async def fetch_proxies(self):
+        # every pattern refilling at the same time shares one fetch
+        if self._fetching is None or self._fetching.done():
+            self._fetching = asyncio.ensure_future(self._fetch_all())
+        return await asyncio.shield(self._fetching)
+
+    async def _fetch_all(self):
+        # all sources at once, a proxy offered by several sources is kept once
+        results = await asyncio.gather(*[self._fetch(source) for source in proxy_sources])
+        proxies = dict()
+        for source_proxies in results:
+            for proxy in source_proxies:
+                proxies.setdefault(str(proxy), proxy)
+        return list(proxies.values())
+
+    @staticmethod
+    async def _fetch(source):
+        logger.debug("start fetching proxy from source {}".format(source.tag))
+        try:
+            return [proxy async for proxy in source.fetch_proxies()]
+        except Exception as e:
+            logger.warning("unable to fetch proxy from {}, {}".format(source.tag, e), exc_info=True)
+            return list()
+
+    async def _add_proxies(self, proxies, pattern_str, num=None):
+        # ADD_SCRIPT checks and writes a batch in one round trip, batches keep redis responsive on big syncs
         added_num = 0
-        for source in proxy_sources:
-            logger.debug("start fetching proxy from source {}".format(source.tag))
-            try:
-                async for proxy in source.fetch_proxies():
-                    if await self._add_proxy(proxy, pattern_str):
-                        added_num += 1
-                        if added_num >= num:
-                            break
-            except Exception as e:
-                logger.warning("unable to fetch proxy from {}, {}".format(source.tag, e), exc_info=True)
+        pattern_strs = [pattern_str] if pattern_str == 'public_proxies' else [pattern_str, 'public_proxies']
+        keys = list()
+        for p in pattern_strs:
+            keys += [p, p + '_fail', self.cache.version_key(p)]
+        for i in range(0, len(proxies), self.ADD_BATCH_SIZE):
+            limit = 0 if num is None else num - added_num
+            if num is not None and limit <= 0:
+                break
+            args = [int(time.time()), self.RENEW_TIME, limit]
+            records = dict()
+            for proxy in proxies[i:i + self.ADD_BATCH_SIZE]:
+                records[str(proxy)] = proxy.dumps()
+                args += [str(proxy), records[str(proxy)]]
+            result = await add_script(self.redis, keys, args)
+            added_num += result[0]
+            for p, version, added in zip(pattern_strs, result[1::2], result[2::2]):
+                if added:
+                    # every pool caches its own copy, scores change independently
+                    self.cache.apply(p, version, put=[Proxy.loads(records[s], s) for s in added])
         return added_num
 
-    async def _add_proxy(self, proxy, pattern_str):
-        for p in {pattern_str, 'public_proxies'}:
-            del_info_json = await self.redis.hget(p + '_fail', str(proxy))
-            if del_info_json is not None:
-                del_info = json.loads(del_info_json)
-                del_time = del_info['delete_time']
-                if int(time.time()) - del_time < self.RENEW_TIME:
-                    return False
-                else:
-                    await self.redis.hdel(p + '_fail', str(proxy))
-            if await self.redis.hexists(pattern_str, str(proxy)):
-                return False
-            await proxy.store(p, self.redis)
-        return True
-
     async def proxy_count(self, pattern_str):
-        return await self.redis.hlen(pattern_str)
+        return len(await self.cache.pool(pattern_str))
 
     async def add_proxies_for_pattern(self, pattern_str):
+        # refill up to pool_size once the pool is under the low watermark
         added_num = 0
         proxy_count = await self.proxy_count(pattern_str)
-        if proxy_count < self.config.pool_size:
+        if proxy_count < self.config.pool_low_watermark:
             now = int(time.time())
-            if now - self._last_add_time[pattern_str] < 5:
+            if now - self._last_add_time[pattern_str] < self.ADD_INTERVAL:
                 return added_num
             else:
                 self._last_add_time[pattern_str] = now
+            # other workers share the pools, only one of them refills per interval
+            if not await self.redis.set(pattern_str + '_refill_lock', now, expire=self.ADD_INTERVAL,
+                                        exist=self.redis.SET_IF_NOT_EXIST):
+                return added_num
 
             logger.info("proxy not enough for {}, now has {}, start adding".format(pattern_str, proxy_count))
             if pattern_str != 'public_proxies':
                 added_num += await self.sync_public(pattern_str)
-            added_num += await self.add_proxies(pattern_str, self.config.pool_size - proxy_count)
+            if proxy_count + added_num < self.config.pool_size:
+                added_num += await self.add_proxies(pattern_str, self.config.pool_size - proxy_count - added_num)
             logger.info("{} proxies added for {}".format(added_num, pattern_str))
             if added_num == 0:
                 logger.warning("no proxy fetched, consider adding more sources")
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import tempfile
+
+
+class RequestBody(object):
+    # a request body read once and replayed to every proxy of a fan-out:
+    # small bodies are kept as one bytes object, larger ones are spooled to a temp file
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.data = None
+        self.size = 0
+        self._file = None
+
+    @classmethod
+    async def read(cls, content, spool_size):
+        body = cls()
+        chunks = list()
+        async for chunk in content.iter_chunked(cls.CHUNK_SIZE):
+            body.size += len(chunk)
+            if body._file is not None:
+                body._file.write(chunk)
+                continue
+            chunks.append(chunk)
+            if body.size > spool_size:
+                body._file = tempfile.TemporaryFile()
+                body._file.write(b''.join(chunks))
+                chunks = None
+        if body._file is None:
+            body.data = b''.join(chunks)
+        else:
+            body._file.flush()
+        return body
+
+    @property
+    def spooled(self):
+        return self._file is not None
+
+    def payload(self):
+        # a fresh data argument for one upstream request, bytes are shared and never copied
+        if self._file is None:
+            return self.data
+        return self._iter_file()
+
+    async def _iter_file(self):
+        # pread keeps an offset per request, so concurrent replays do not share a file position
+        offset = 0
+        while offset < self.size:
+            chunk = os.pread(self._file.fileno(), self.CHUNK_SIZE, offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def digest(self):
+        # None for spooled bodies, they are not read back just to be hashed
+        if self._file is not None:
+            return None
+        return hashlib.sha1(self.data).hexdigest()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        if self._file is None:
+            return self.data.decode('utf-8', errors='replace')
+        return '<{} bytes spooled to disk>'.format(self.size)
@@ -1,22 +1,119 @@
+import asyncio
+import codecs
 import json
 import time
 
+import aiohttp
 from aiohttp import ClientResponse
 
+from models.request import RequestBody
 
-class FailedResponse(object):
+
+# reason codes by exception class, the first match wins so subclasses go before their bases
+_EXCEPTION_REASONS = (
+    (asyncio.TimeoutError, 'timeout'),
+    (aiohttp.ClientProxyConnectionError, 'proxy_connect'),
+    ((aiohttp.ClientConnectorError, ConnectionError), 'connect'),
+    ((aiohttp.ServerDisconnectedError, aiohttp.ClientPayloadError), 'disconnected'),
+    (aiohttp.ClientResponseError, 'http'),
+)
+
+
+def _exception_reason(e):
+    for classes, reason in _EXCEPTION_REASONS:
+        if isinstance(e, classes):
+            return reason
+    return 'error'
+
+
+class Failure(object):
+    # why one attempt failed. only the exception's type name and message are kept, holding the exception
+    # itself would keep its traceback and every frame on it alive as long as the response
+    __slots__ = ('proxy', 'reason', 'exc_type', 'detail')
+
+    def __init__(self, proxy, reason, detail=None, exc_type=None):
+        self.proxy = proxy
+        self.reason = reason
+        self.exc_type = exc_type
+        self.detail = detail
+
+    @classmethod
+    def from_exception(cls, proxy, e):
+        return cls(proxy, _exception_reason(e), str(e) or type(e).__name__, type(e).__name__)
+
+    def summary(self):
+        return '{} {}: {}\n'.format(self.proxy, self.reason, self.detail)
+
+    def render(self):
+        if self.exc_type is None:
+            return '{}\n{}\n'.format(self.proxy, self.detail)
+        return '{}\n{}: {}\n'.format(self.proxy, self.exc_type, self.detail)
+
+    def to_dict(self):
+        return {
+            'proxy': str(self.proxy),
+            'reason': self.reason,
+            'exc_type': self.exc_type,
+            'detail': self.detail
+        }
+
+
+class Failures(object):
+    failures = ()
+
+    def add_failure(self, failure):
+        if not self.failures:
+            self.failures = list()
+        self.failures.append(failure)
+
+    @property
+    def traceback(self):
+        if not self.failures:
+            return None
+        return ''.join(failure.render() for failure in self.failures)
+
+    def failure_summary(self):
+        if not self.failures:
+            return None
+        return ''.join(failure.summary() for failure in self.failures)
+
+
+class FailedResponse(Failures):
     cancelled = False
     proxy = None
     valid = False
-    traceback = None
+    elapsed = None
 
 
-class Response(ClientResponse):
+class Response(Failures, ClientResponse):
     proxy = None
     valid = None
-    traceback = None
     cancelled = False
     request_data = None
+    prefix = None
+    elapsed = None
+    _on_release = None
+
+    def on_release(self, callback):
+        # callback() runs once, when the connection is released or closed
+        self._on_release = callback
+
+    def _call_on_release(self):
+        callback, self._on_release = self._on_release, None
+        if callback is not None:
+            callback()
+
+    def release(self):
+        try:
+            return super(Response, self).release()
+        finally:
+            self._call_on_release()
+
+    def close(self):
+        try:
+            super(Response, self).close()
+        finally:
+            self._call_on_release()
 
     def get_encoding(self):
         encoding = super(Response, self).get_encoding()
@@ -24,17 +121,67 @@ class Response(ClientResponse):
             encoding = 'gbk'
         return encoding
 
-    async def info_json(self):
-        text = await self.text()
+    @property
+    def body(self):
+        # the body read before the connection went back to the pool, read() refuses once it has
+        return self._body
+
+    @property
+    def streaming(self):
+        # only a prefix has been read, the rest is still on the wire
+        return self.prefix is not None and self._body is None
+
+    async def read_prefix(self, limit):
+        chunks = list()
+        size = 0
+        while size < limit:
+            chunk = await self.content.read(limit - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        self.prefix = b''.join(chunks)
+        if self.content.at_eof():
+            self._body = self.prefix
+        return self.prefix
+
+    def check_body(self):
+        body = self.prefix if self.streaming else self._body
+        try:
+            encoding = codecs.lookup(self.get_encoding()).name
+        except (RuntimeError, LookupError):
+            encoding = 'utf-8'
+        return body or b'', encoding
+
+    async def check_text(self):
+        if not self.streaming:
+            return await self.text()
+        try:
+            return self.prefix.decode(self.get_encoding(), errors='replace')
+        except (RuntimeError, LookupError):
+            return self.prefix.decode('utf-8', errors='replace')
+
+    async def info_json(self, with_text=True, max_size=None):
+        # without text only the failure summaries are stored, max_size caps the text and the request data
+        text, tb = None, self.failure_summary()
+        if with_text:
+            text, tb = await self.check_text(), self.traceback
+        data = self.request_data
+        if isinstance(data, RequestBody):
+            data = str(data)
+        if max_size is not None:
+            text = text[:max_size] if text is not None else None
+            data = data[:max_size] if isinstance(data, str) else data
         return json.dumps({
             'url': str(self.url),
             'status_code': self.status,
             'valid': self.valid,
             'text': text,
             'proxy': str(self.proxy),
-            'traceback': self.traceback,
+            'traceback': tb,
+            'failures': [failure.to_dict() for failure in self.failures],
             'time': int(time.time()),
             'headers': dict(self.request_info.headers),
             'method': self.request_info.method,
-            'data': self.request_data
+            'data': data
         })
@@ -0,0 +1,43 @@
+import time
+from array import array
+
+
+class TimeSeries(object):
+    # counts per time slot of `resolution` seconds in a ring covering `retention` seconds.
+    # slots are numbered from the epoch, a ring position remembers which slot it holds,
+    # so positions left over from an earlier lap read as zero
+    def __init__(self, resolution, retention):
+        self.resolution = resolution
+        self.size = max(int(retention // resolution), 1)
+        self.counts = array('q', [0]) * self.size
+        self.slots = array('q', [-1]) * self.size
+
+    def slot(self, now=None):
+        return int((time.time() if now is None else now) // self.resolution)
+
+    def add(self, n=1, now=None):
+        slot = self.slot(now)
+        i = slot % self.size
+        if self.slots[i] != slot:
+            self.slots[i] = slot
+            self.counts[i] = 0
+        self.counts[i] += n
+
+    def get(self, slot):
+        i = slot % self.size
+        return self.counts[i] if self.slots[i] == slot else 0
+
+    def window(self, points, now=None):
+        # counts of the last `points` slots, oldest first
+        last = self.slot(now)
+        return [self.get(slot) for slot in range(last - points + 1, last + 1)]
+
+    def to_dict(self, points, now=None):
+        # non-empty slots of the window, keyed by slot number as str so it survives json
+        last = self.slot(now)
+        d = dict()
+        for slot in range(last - min(points, self.size) + 1, last + 1):
+            n = self.get(slot)
+            if n:
+                d[str(slot)] = n
+        return d
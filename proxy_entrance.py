@@ -1,4 +1,6 @@
+import argparse
 import asyncio
+import multiprocessing
 
 try:
     import uvloop
@@ -8,14 +10,37 @@ except ImportError:
 
 from aiohttp import web
 
-from core import proxy_server
+from core import proxy_server, tunnel
 from config import conf
 
 
-def run_server():
+def run_server(workers=1):
+    conf.workers = workers
     app = proxy_server.ProxyServer(conf)
-    web.run_app(app, port=conf.port)
+    if conf.connect_tunnel:
+        tunnel.run_app(app, port=conf.port, reuse_port=workers > 1)
+    else:
+        web.run_app(app, port=conf.port, reuse_port=workers > 1)
+
+
+def run_workers(workers):
+    # every worker binds the port itself with SO_REUSEPORT and the kernel spreads connections
+    processes = [multiprocessing.Process(target=run_server, args=(workers,)) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.join()
 
 
 if __name__ == '__main__':
-    run_server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=conf.workers, help='number of server processes')
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_workers(args.workers)
+    else:
+        run_server()
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import conf  # noqa: E402
+
+# tests only touch this db, it is flushed before and after each test
+test_db = 15
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope='session')
+def redis_addr():
+    # the redis from config.py when one answers, otherwise an in-process fakeredis
+    addr = (conf.redis_host, int(conf.redis_port))
+    try:
+        socket.create_connection(addr, timeout=0.5).close()
+        return 'redis://{}:{}/{}'.format(addr[0], addr[1], test_db), conf.redis_password
+    except OSError:
+        pass
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'redis://{}:{}/{}'.format(server.server_address[0], server.server_address[1], test_db), None
+
+
+@pytest.fixture
+def redis(loop, redis_addr):
+    import aioredis
+    addr, password = redis_addr
+
+    async def connect():
+        r = await aioredis.create_redis_pool(addr, password=password, encoding='utf8')
+        await r.flushdb()
+        return r
+
+    async def close(r):
+        await r.flushdb()
+        r.close()
+        await r.wait_closed()
+
+    r = loop.run_until_complete(connect())
+    yield r
+    loop.run_until_complete(close(r))
+
+
+@pytest.fixture
+def sessions(loop):
+    from core.crawler import open_session_pool
+    pool = open_session_pool(10, 10, 30)
+    yield pool
+    loop.run_until_complete(pool.close())
+
+
+class Upstream(object):
+    # a local http proxy standing in for the upstream ones: answers every request itself with the
+    # page in self.page and keeps (method, url, body) of what it got in self.requests
+
+    def __init__(self):
+        self.requests = list()
+        self.page = '<html><head><title>Example</title></head><body></body></html>'
+        self.status = 200
+        self.headers = {}
+        self.runner = None
+        self.proxy = None
+
+    async def handle(self, request):
+        from aiohttp import web
+        body = await request.read()
+        self.requests.append((request.method, str(request.url), body))
+        return web.Response(status=self.status, text=self.page, content_type='text/html', headers=self.headers)
+
+    async def start(self):
+        from aiohttp import web
+        from models.proxy import Proxy
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.proxy = Proxy('127.0.0.1', port)
+
+
+@pytest.fixture
+def upstream(loop):
+    server = Upstream()
+    loop.run_until_complete(server.start())
+    yield server
+    loop.run_until_complete(server.runner.cleanup())
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+from multidict import CIMultiDict
+
+from core.cache import ResponseCache
+from models.pattern import Checker, Pattern
+
+VARY = ('Accept', 'Cookie')
+
+
+def _pattern(**settings):
+    return Pattern('example.com', None, None, Checker(), **settings)
+
+
+def _cache(redis=None, max_bytes=1024, ttl=60, max_body_size=100, shared=False):
+    return ResponseCache(redis, max_bytes, ttl, max_body_size, VARY, shared)
+
+
+def _key(cache, method='GET', pattern=None, body=None, **headers):
+    return cache.key(method, 'http://example.com/', CIMultiDict(headers), pattern or _pattern(), body)
+
+
+def test_only_get_and_head_without_a_body_are_cached():
+    cache = _cache()
+    assert _key(cache, 'GET') is not None
+    assert _key(cache, 'HEAD') not in (None, _key(cache, 'GET'))
+    for method in ('POST', 'PUT', 'DELETE', 'PATCH'):
+        assert _key(cache, method) is None
+    assert _key(cache, body=b'') is None
+
+
+def test_ttl_of_zero_turns_caching_off():
+    assert _key(_cache(ttl=0)) is None
+    assert _key(_cache(ttl=0), pattern=_pattern(cache_ttl=10)) is not None
+    assert _key(_cache(), pattern=_pattern(cache_ttl=0)) is None
+
+
+def test_key_varies_on_the_vary_headers_only():
+    cache = _cache()
+    assert _key(cache, Accept='text/html') != _key(cache, Accept='application/json')
+    assert _key(cache, Cookie='a=1') != _key(cache)
+    assert _key(cache, Referer='http://a/') == _key(cache, Referer='http://b/')
+
+
+def test_entries_expire(loop, monkeypatch):
+    cache = _cache()
+    now = time.time()
+
+    async def run():
+        await cache.set('k', _pattern(cache_ttl=10), 200, 'text/html', 'proxy', b'body')
+        assert (await cache.get('k')).body == b'body'
+        monkeypatch.setattr(time, 'time', lambda: now + 11)
+        assert await cache.get('k') is None
+    loop.run_until_complete(run())
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize('status, stored', [(200, True), (404, True), (301, True), (206, False), (302, False),
+                                            (307, False)])
+def test_only_cacheable_statuses_are_stored(loop, status, stored):
+    cache = _cache()
+    loop.run_until_complete(cache.set('k', _pattern(), status, None, 'proxy', b'body'))
+    assert (len(cache) == 1) is stored
+
+
+def test_memory_is_bounded_by_body_bytes(loop):
+    cache = _cache(max_bytes=10, max_body_size=8)
+    pattern = _pattern()
+
+    async def run():
+        for key in ('a', 'b'):
+            await cache.set(key, pattern, 200, None, 'proxy', b'1234')
+        # a was used last, b goes first
+        assert await cache.get('a') is not None
+        await cache.set('c', pattern, 200, None, 'proxy', b'1234')
+        assert await cache.get('b') is None
+        assert await cache.get('a') is not None and await cache.get('c') is not None
+        # over max_body_size, never stored
+        await cache.set('d', pattern, 200, None, 'proxy', b'123456789')
+        assert await cache.get('d') is None
+        # a pattern's own size goes first
+        await cache.set('e', _pattern(cache_size=2), 200, None, 'proxy', b'123')
+        assert await cache.get('e') is None
+    loop.run_until_complete(run())
+    assert cache._size == 8 and len(cache) == 2
+
+
+def test_shared_entries_reach_other_workers(loop, redis):
+    first, second = _cache(redis, shared=True), _cache(redis, shared=True)
+    body = b'\x00\xffbinary\nbody'
+
+    async def run():
+        await first.set('k', _pattern(cache_ttl=30), 200, 'application/octet-stream', 'http://10.0.0.1:80', body)
+        entry = await second.get('k')
+        assert (entry.status, entry.content_type, entry.proxy, entry.body) == \
+            (200, 'application/octet-stream', 'http://10.0.0.1:80', body)
+        assert 0 < await redis.ttl(ResponseCache.KEY_PREFIX + 'k') <= 30
+        # not shared, only in memory
+        await _cache(redis).set('local', _pattern(), 200, None, 'proxy', body)
+        assert await second.get('local') is None
+    loop.run_until_complete(run())
+    assert len(second) == 1
@@ -0,0 +1,42 @@
+from multidict import CIMultiDict
+
+from core.coalesce import SingleFlight
+
+
+def _key(method='GET', **headers):
+    return SingleFlight(10).key(method, 'http://example.com/', CIMultiDict(headers))
+
+
+def test_only_get_and_head_are_shared():
+    assert _key('GET') is not None
+    assert _key('HEAD') is not None
+    assert _key('POST') is None
+    assert _key('DELETE') is None
+    assert _key('GET') != _key('HEAD')
+
+
+def test_any_end_to_end_header_splits_the_key():
+    assert _key(Accept='text/html') == _key(Accept='text/html')
+    assert _key(Accept='text/html') != _key(Accept='application/json')
+    assert _key(Referer='http://a/') != _key(Referer='http://b/')
+    assert _key(**{'X-Token': 'a'}) != _key(**{'X-Token': 'b'})
+    assert _key(Cookie='a=1') != _key()
+
+
+def test_header_order_and_case_do_not_matter():
+    a = CIMultiDict([('Accept', 'text/html'), ('Referer', 'http://a/')])
+    b = CIMultiDict([('referer', 'http://a/'), ('ACCEPT', 'text/html')])
+    flights = SingleFlight(10)
+    assert flights.key('GET', 'http://example.com/', a) == flights.key('GET', 'http://example.com/', b)
+
+
+def test_repeated_headers_keep_their_order():
+    a = CIMultiDict([('X-Value', '1'), ('X-Value', '2')])
+    b = CIMultiDict([('X-Value', '2'), ('X-Value', '1')])
+    flights = SingleFlight(10)
+    assert flights.key('GET', 'http://example.com/', a) != flights.key('GET', 'http://example.com/', b)
+
+
+def test_hop_by_hop_headers_are_ignored():
+    assert _key(Connection='keep-alive', **{'Keep-Alive': 'timeout=5', 'Proxy-Authorization': 'Basic x'}) == _key()
+    assert _key(Connection='close, X-Hop', **{'X-Hop': 'a'}) == _key(**{'X-Hop': 'b', 'Connection': 'X-Hop'})
@@ -0,0 +1,63 @@
+import asyncio
+
+from core.crawler import SessionPool, fanout_stats, latency_windows, race
+from models.proxy import Proxy
+from models.response import FailedResponse
+
+
+class Attempt(FailedResponse):
+
+    def __init__(self, proxy, valid, body=b''):
+        self.proxy = proxy
+        self.valid = valid
+        self._body = body
+
+
+def _attempts(plan):
+    # plan maps a proxy to (seconds, valid)
+    async def attempt(proxy):
+        delay, valid = plan[proxy]
+        await asyncio.sleep(delay)
+        return Attempt(proxy, valid, b'x' * 10)
+    return attempt
+
+
+def test_every_completed_attempt_is_recorded(loop):
+    failing, slow, fast = Proxy('10.0.0.1', 80), Proxy('10.0.0.2', 80), Proxy('10.0.0.3', 80)
+    plan = {failing: (0.01, False), fast: (0.05, True), slow: (1, True)}
+    r = loop.run_until_complete(race(_attempts(plan), [failing, fast, slow], window='test_all'))
+    assert r.proxy is fast
+    assert (failing.latency.count, failing.latency.success_rate) == (1, 0)
+    assert (fast.latency.count, fast.latency.success_rate) == (1, 1)
+    # the slow one was cancelled, it never completed
+    assert slow.latency.count == 0
+    assert len(latency_windows['test_all'].samples) == 2
+
+
+def test_hedge_counts_avoided_attempts(loop):
+    first, second = Proxy('10.0.0.4', 80), Proxy('10.0.0.5', 80)
+    plan = {first: (0.01, True), second: (0.01, True)}
+    before = dict(fanout_stats)
+    r = loop.run_until_complete(race(_attempts(plan), [first, second], hedge=True, window='test_hedge'))
+    assert r.proxy is first
+    assert fanout_stats['planned'] - before['planned'] == 2
+    assert fanout_stats['launched'] - before['launched'] == 1
+    assert fanout_stats['bytes'] - before['bytes'] == 10
+
+
+def test_evicted_session_waits_for_its_requests(loop):
+    async def run():
+        pool = SessionPool(10, 10, 30)
+        pool.MAX_SESSIONS = 1
+        busy = pool.acquire('http://10.0.0.6:80')
+        # each new session evicts the previous one
+        idle = pool.get('http://10.0.0.7:80')
+        pool.get('http://10.0.0.8:80')
+        await asyncio.sleep(0)
+        assert not busy.closed
+        pool.release(busy)
+        await asyncio.sleep(0)
+        assert busy.closed
+        assert idle.closed
+        await pool.close()
+    loop.run_until_complete(run())
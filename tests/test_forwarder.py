@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from multidict import CIMultiDict
+
+from config import conf
+from core.cache import ResponseCache
+from core.forwarder import forward
+from models.pattern import Checker, Pattern
+from models.request import RequestBody
+
+
+class Index(object):
+
+    def closest_pattern(self, url):
+        return 'example.com', None
+
+
+class PatternManager(object):
+    t = Index()
+
+    def __init__(self):
+        self.pattern = Pattern('example.com', None, None, Checker())
+
+    def get_pattern(self, pattern_str):
+        return self.pattern
+
+
+class ProxyManager(object):
+
+    def __init__(self, proxies):
+        self.proxies = proxies
+
+    async def select_proxies(self, pattern_str, **kwargs):
+        return list(self.proxies)
+
+
+def _forward(loop, upstream, method, body=None, **kwargs):
+    pom = ProxyManager([upstream.proxy])
+    return loop.run_until_complete(forward(method, 'http://example.com/page', PatternManager(), pom,
+                                           headers=CIMultiDict(), body=body, **kwargs))
+
+
+@pytest.mark.parametrize('method', ['GET', 'POST', 'PUT', 'DELETE'])
+def test_forward_returns_the_upstream_body(loop, sessions, upstream, method):
+    response = _forward(loop, upstream, method)
+    assert response.status == 200
+    assert response.body == upstream.page.encode()
+    assert response.headers['Via-Proxy'] == str(upstream.proxy)
+    assert upstream.requests[0][:2] == (method, 'http://example.com/page')
+
+
+def test_forward_head(loop, sessions, upstream):
+    response = _forward(loop, upstream, 'HEAD')
+    assert response.status == 200
+    assert not response.body
+
+
+def test_forward_stream_of_a_short_page(loop, sessions, upstream):
+    # read whole by the check prefix, so it is answered like a buffered one
+    response = _forward(loop, upstream, 'GET', stream=True)
+    assert response.status == 200
+    assert response.body == upstream.page.encode()
+
+
+@pytest.mark.parametrize('hedge', [False, True])
+def test_forward_fanned_out(loop, sessions, upstream, hedge):
+    pom = ProxyManager([upstream.proxy] * 3)
+    response = loop.run_until_complete(forward('GET', 'http://example.com/page', PatternManager(), pom,
+                                               headers=CIMultiDict(), hedge=hedge))
+    assert response.body == upstream.page.encode()
+
+
+def test_cached_response_is_served_without_a_crawl(loop, sessions, upstream):
+    cache = ResponseCache(None, 1024 * 1024, ttl=60)
+    pam, pom = PatternManager(), ProxyManager([upstream.proxy])
+
+    def get():
+        return loop.run_until_complete(forward('GET', 'http://example.com/page', pam, pom,
+                                               headers=CIMultiDict(), cache=cache))
+    first, second = get(), get()
+    assert 'X-Cache' not in first.headers
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.body == first.body == upstream.page.encode()
+    assert second.headers['Via-Proxy'] == str(upstream.proxy)
+    assert len(upstream.requests) == 1
+
+
+class Content(object):
+    # a client body arriving in uneven chunks
+
+    def __init__(self, data, chunk_size):
+        self.chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    async def iter_chunked(self, n):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def _body(loop, data, spool_size):
+    return loop.run_until_complete(RequestBody.read(Content(data, 7000), spool_size))
+
+
+@pytest.mark.parametrize('method', ['POST', 'PUT'])
+@pytest.mark.parametrize('spooled', [False, True])
+@pytest.mark.parametrize('hedge', [False, True])
+@pytest.mark.parametrize('content_length', [False, True])
+def test_every_attempt_sends_the_whole_body(loop, sessions, upstream, method, spooled, hedge, content_length,
+                                            monkeypatch):
+    monkeypatch.setattr(conf, 'hedge_min_delay', 0.01)
+    # no attempt passes the check, so every one of them runs to the end
+    upstream.status = 500
+    data = bytes(range(256)) * 1000
+    body = _body(loop, data, 1024 if spooled else len(data))
+    assert body.spooled is spooled
+    headers = CIMultiDict({'Content-Length': str(len(body))} if content_length else {})
+    pom = ProxyManager([upstream.proxy] * 3)
+    try:
+        response = loop.run_until_complete(forward(method, 'http://example.com/page', PatternManager(), pom,
+                                                   headers=headers, body=body, hedge=hedge))
+    finally:
+        body.close()
+    assert response.status == 417
+    assert [(m, b) for m, _, b in upstream.requests] == [(method, data)] * 3
+
+
+def test_body_replays_are_independent(loop):
+    data = b'0123456789' * 20000
+    body = _body(loop, data, 1024)
+
+    async def read(payload):
+        return b''.join([chunk async for chunk in payload])
+
+    async def run():
+        return await asyncio.gather(*[read(body.payload()) for _ in range(3)])
+    try:
+        assert loop.run_until_complete(run()) == [data] * 3
+    finally:
+        body.close()
+    small = _body(loop, b'small', 1024)
+    assert small.payload() == small.payload() == b'small'
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from core.limiter import LEASE_SCRIPT, Limiter, RateLimited, _Limit, lease_script, limit_stats
+from models.pattern import Checker, Pattern
+
+
+def _pattern(**settings):
+    return Pattern('example.com', None, None, Checker(), **settings)
+
+
+def test_bucket_refills_at_its_rate():
+    limit = _Limit('host:example.com', 10, 0)
+    limit.updated = 100
+    assert limit.take_local(10, 100) == 0
+    assert limit.take_local(1, 100) == pytest.approx(0.1)
+    assert limit.take_local(1, 100.5) == 0
+    assert limit.tokens == pytest.approx(4)
+    # never more than a burst of tokens
+    assert limit.take_local(0, 1000) == 0
+    assert limit.tokens == limit.burst
+
+
+def test_queued_counts_a_request_once(loop):
+    limiter = Limiter(None, host_rate=1, host_max_inflight=1, pattern_rate=1, pattern_max_inflight=1)
+    pattern = _pattern()
+
+    async def run():
+        first = await limiter.acquire('example.com', pattern)
+        queued = limit_stats['queued']
+        second = asyncio.ensure_future(limiter.acquire('example.com', pattern))
+        await asyncio.sleep(0.01)
+        limiter.release(first)
+        # waits on both in-flight caps and both buckets
+        limiter.release(await second)
+        return limit_stats['queued'] - queued
+    assert loop.run_until_complete(run()) == 1
+
+
+def test_request_over_the_cap_is_rejected(loop):
+    limiter = Limiter(None, host_max_inflight=1, queue_timeout=0)
+
+    async def run():
+        acquired = await limiter.acquire('example.com', _pattern())
+        with pytest.raises(RateLimited):
+            await limiter.acquire('example.com', _pattern())
+        limiter.release(acquired)
+    loop.run_until_complete(run())
+
+
+def test_idle_limits_are_evicted(loop):
+    limiter = Limiter(None, host_max_inflight=1)
+    limiter.MAX_LIMITS = 2
+    pattern = _pattern()
+
+    async def run():
+        held = await limiter.acquire('a.com', pattern)
+        for host in ('b.com', 'c.com', 'd.com'):
+            limiter.release(await limiter.acquire(host, pattern))
+        return held
+    held = loop.run_until_complete(run())
+    # a.com is still held, the least recently used idle ones go
+    assert list(limiter._limits) == ['host:a.com', 'host:d.com']
+    limiter.release(held)
+    assert limiter._limits['host:a.com'].inflight == 0
+
+
+def test_limit_with_tokens_spent_is_kept():
+    limiter = Limiter(None, host_rate=1)
+    limiter.MAX_LIMITS = 1
+    limiter._limit('host:a.com', 1, 0).tokens = 0
+    limiter._limit('host:b.com', 1, 0)
+    assert 'host:a.com' in limiter._limits
+
+
+def test_lease_script(loop, redis):
+    async def run():
+        # 10 tokens a second, burst 10: take 8, then 2 of the 5 wanted are left, then none
+        first = await lease_script(redis, ['bucket'], [1000, 10, 10, 8, 1])
+        second = await lease_script(redis, ['bucket'], [1000, 10, 10, 5, 1])
+        third = await lease_script(redis, ['bucket'], [1000, 10, 10, 5, 1])
+        # 150ms later 1.5 tokens have come back
+        fourth = await lease_script(redis, ['bucket'], [1150, 10, 10, 5, 1])
+        return first, second, third, fourth, await redis.pttl('bucket')
+    first, second, third, fourth, ttl = loop.run_until_complete(run())
+    assert first == [8, 0]
+    assert second == [2, 0]
+    assert third == [0, 100]
+    assert fourth == [1, 0]
+    assert 0 < ttl <= 2000
+    assert lease_script.source == LEASE_SCRIPT
+
+
+def test_shared_limiter_leases_from_redis(loop, redis):
+    limiter = Limiter(redis, host_rate=2, shared=True, lease_size=2, queue_timeout=0)
+    pattern = _pattern()
+
+    async def run():
+        for _ in range(2):
+            limiter.release(await limiter.acquire('example.com', pattern))
+        with pytest.raises(RateLimited):
+            await limiter.acquire('example.com', pattern)
+    loop.run_until_complete(run())
@@ -0,0 +1,67 @@
+import logging
+import logging.handlers
+import threading
+
+import log_utils
+from log_utils import LogHandler, _LogQueue, _QueueHandler
+
+
+class Capture(logging.Handler):
+
+    def __init__(self, gate=None):
+        super(Capture, self).__init__()
+        self.messages = list()
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.messages.append(record.getMessage())
+
+
+def _logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+def test_records_are_written_by_the_listener():
+    log_queue = _LogQueue()
+    first, second = Capture(), Capture()
+    second.setLevel(logging.WARNING)
+    _logger('test_listener', _QueueHandler((first, second), log_queue)).info('hello %s', 'world')
+    _logger('test_listener_other', _QueueHandler((second,), log_queue)).warning('other')
+    log_queue.stop()
+    assert first.messages == ['hello world']
+    assert second.messages == ['other']
+    assert log_queue.listener is None
+
+
+def test_dropped_records_are_reported():
+    gate = threading.Event()
+    target = Capture(gate)
+    log_queue = _LogQueue()
+    log_queue.MAX_QUEUE_SIZE = 2
+    logger = _logger('test_dropped', _QueueHandler((target,), log_queue))
+    for i in range(10):
+        logger.info('record %d', i)
+    assert log_queue.dropped > 0
+    gate.set()
+    log_queue.stop()
+    assert target.messages[-1].endswith('log records dropped, the log queue was full')
+    dropped = int(target.messages[-1].split()[0])
+    assert len(target.messages) - 1 + dropped == 10
+
+
+def test_loggers_share_one_queue_and_listener():
+    loggers = [LogHandler('test_shared', stream=False) for _ in range(3)] + [LogHandler('test_shared_other')]
+    handlers = [logger._queue_handler for logger in loggers]
+    assert handlers[0] is handlers[1] is handlers[2]
+    assert {handler.log_queue for handler in handlers} == {log_utils._log_queue}
+    for logger in loggers:
+        logger.info('shared')
+    listeners = [t for t in threading.enumerate()
+                 if getattr(getattr(t, '_target', None), '__func__', None) is logging.handlers.QueueListener._monitor]
+    assert listeners == [log_utils._log_queue.listener._thread]
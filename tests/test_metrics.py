@@ -0,0 +1,73 @@
+import asyncio
+
+import aioredis
+
+from core import metrics
+from core.cluster import ClusterStats
+from models.proxy import Proxy, ProxyPool
+
+
+def test_redis_commands_are_timed_but_buffered_ones_are_not(loop, redis_addr):
+    addr, password = redis_addr
+
+    async def run():
+        redis = await aioredis.create_redis_pool(addr, password=password, encoding='utf8',
+                                                 commands_factory=metrics.InstrumentedRedis)
+        try:
+            count = metrics.redis_seconds.count
+            await redis.set('metrics_test', 1)
+            assert await redis.get('metrics_test') == '1'
+            assert metrics.redis_seconds.count == count + 2
+            # the buffered INCRs go out with EXEC, only EXEC itself is timed
+            count = metrics.redis_seconds.count
+            tr = redis.multi_exec()
+            first, second = tr.incr('metrics_test'), tr.incr('metrics_test')
+            assert await tr.execute() == [2, 3]
+            assert [await first, await second] == [2, 3]
+            # let any done callbacks run
+            await asyncio.sleep(0.01)
+            assert metrics.redis_seconds.count == count
+            await redis.delete('metrics_test')
+        finally:
+            redis.close()
+            await redis.wait_closed()
+    loop.run_until_complete(run())
+
+
+class Saver(object):
+    success_count = 3
+    total_count = 4
+
+
+class PatternManager(object):
+
+    def counters(self):
+        return dict()
+
+
+def test_render():
+    metrics.forward_seconds.observe(0.02)
+    stats = ClusterStats(None, Saver(), PatternManager()).snapshot()
+    proxy = Proxy('10.0.0.1', 8080)
+    proxy.latency.record(0.2, True)
+    text = metrics.render(stats, pools={'exa"mple.com': ProxyPool({str(proxy): proxy})},
+                          widths={'example.com': 3})
+    lines = text.splitlines()
+    assert text.endswith('\n')
+    assert '# TYPE proxy_tower_forward_seconds histogram' in lines
+    assert 'proxy_tower_forward_seconds_bucket{le="+Inf"} ' + str(metrics.forward_seconds.count) in lines
+    assert 'proxy_tower_requests_total 4' in lines
+    assert 'proxy_tower_valid_requests_total 3' in lines
+    assert 'proxy_tower_pattern_fanout_width{pattern="example.com"} 3' in lines
+    assert 'proxy_tower_proxy_success_rate{pattern="exa\\"mple.com",proxy="http://10.0.0.1:8080"} 1.0' in lines
+    # every sample line belongs to a metric declared before it
+    declared = set()
+    for line in lines:
+        if line.startswith('# TYPE '):
+            declared.add(line.split()[2])
+        elif not line.startswith('#'):
+            name = line.split('{')[0].split()[0]
+            assert any(name == d or name.startswith(d + '_') for d in declared), line
+    # cumulative buckets never go down
+    buckets = [int(line.split()[-1]) for line in lines if line.startswith('proxy_tower_forward_seconds_bucket')]
+    assert buckets == sorted(buckets)
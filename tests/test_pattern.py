@@ -0,0 +1,206 @@
+import json
+import pickle
+import random
+
+import pytest
+
+from config import conf
+from models.pattern import NEED_PARSE, CheckPatternTrie, Checker, FanoutController, Pattern, PatternManager
+
+PAGES = [
+    '<html><head><title>{}</title></head><body></body></html>',
+    '<html><head><title>caf&eacute;</title></head><body><a href="/?a=1&amp;b=2">x</a></body></html>',
+    '<html><head><title>a&nbsp;b</title></head></html>',
+    '<html><head><title>&#69;xample</title></head></html>',
+    '<html><head><title>Example&#x20;Domain</title></head></html>',
+    '<html><head><title>Other</title></head></html>',
+]
+VALUES = ['Example', 'Example Domain', 'café', 'a\xa0b', 'a b']
+
+
+@pytest.mark.parametrize('value', VALUES)
+@pytest.mark.parametrize('page', PAGES)
+@pytest.mark.parametrize('as_bytes', [False, True])
+def test_prefilter_never_rejects_a_matching_page(value, page, as_bytes):
+    compiled = Checker().compile('//title/text()', value)
+    body = page.format(value)
+    if as_bytes:
+        body = body.encode('utf-8')
+    reason, body = compiled.precheck(200, body)
+    parsed = compiled.parse_check(body)
+    if parsed is None:
+        assert reason is NEED_PARSE
+    elif reason is not NEED_PARSE:
+        assert 'not in page' in reason
+
+
+def test_prefilter_rejects_without_parsing():
+    compiled = Checker().compile('//title/text()', 'Example')
+    reason, _ = compiled.precheck(200, b'<html><title>Other</title></html>')
+    assert reason == 'xpath check failed, Example not in page'
+
+
+def test_whitelist_and_blacklist():
+    checker = Checker(['captcha'])
+    assert checker.check(200, 'ok page', 'whitelist', 'ok') is None
+    assert 'whitelist check failed' in checker.check(200, 'page', 'whitelist', 'ok')
+    assert 'blacklist' in checker.check(200, b'please solve the captcha', 'whitelist', 'solve')
+    assert 'status_code' in checker.check(500, 'ok', 'whitelist', 'ok')
+
+
+def test_failures_carry_a_reason_code():
+    checker = Checker(['captcha'])
+    cases = [
+        (500, 'ok', 'whitelist', 'ok', 'status_code'),
+        (200, 'captcha', 'whitelist', 'ok', 'global_blacklist'),
+        (200, 'page', 'whitelist', 'ok', 'whitelist'),
+        (200, '<title>Other</title>', '//title/text()', 'Example', 'xpath'),
+        (200, '<title>Example</title>', '//title[', 'Example', 'check_error'),
+    ]
+    for status, body, rule, value, code in cases:
+        reason = checker.check(status, body, rule, value)
+        assert reason.code == code
+        restored = pickle.loads(pickle.dumps(reason))
+        assert (restored.code, restored) == (code, reason)
+
+
+def test_startup_keeps_public_proxies_settings(loop, redis):
+    async def run():
+        async with PatternManager(Checker(), None, redis) as pam:
+            await pam.add('public_proxies', None, None, cache_ttl=60)
+        async with PatternManager(Checker(), None, redis) as pam:
+            return pam.get_pattern('public_proxies').cache_ttl
+    assert loop.run_until_complete(run()) == 60
+
+
+def test_startup_creates_public_proxies(loop, redis):
+    async def run():
+        async with PatternManager(Checker(), None, redis) as pam:
+            return pam.get_pattern('public_proxies'), await redis.hexists(pam.key, 'public_proxies')
+    pattern, stored = loop.run_until_complete(run())
+    assert pattern is not None and stored
+
+
+def _controller(good, bad, slow=0, now=1000, window=60):
+    controller = FanoutController(window)
+    for _ in range(good):
+        controller.record(True, 0.5, 1, now=now)
+    for _ in range(bad):
+        controller.record(False, 0.5, 1, now=now)
+    for _ in range(slow):
+        controller.record(True, 2, 1, now=now)
+    return controller
+
+
+def test_fanout_width_follows_the_success_rate():
+    # the prior alone is p = 0.5, 1 - 0.5 ** 5 >= 0.95
+    assert _controller(0, 0).width(0.95, 1, 10, now=1000) == 5
+    assert _controller(98, 0).width(0.95, 1, 10, now=1000) == 1
+    assert _controller(98, 0).width(0.95, 2, 10, now=1000) == 2
+    assert _controller(0, 98).width(0.95, 1, 10, now=1000) == 10
+    # valid but slower than the latency target counts as a miss
+    assert _controller(0, 0, slow=98).width(0.95, 1, 10, now=1000) == 10
+
+
+def test_fanout_width_forgets_old_attempts():
+    controller = _controller(0, 98, now=1000)
+    assert controller.width(0.95, 1, 10, now=1000) == 10
+    assert controller.width(0.95, 1, 10, now=1000 + 61) == 5
+
+
+def test_fanout_target_of_one_or_more_is_the_widest():
+    controller = _controller(50, 50)
+    assert controller.width(1, 1, 10, now=1000) == 10
+    assert controller.width(1.5, 1, 10, now=1000) == 10
+    assert controller.width(0, 1, 10, now=1000) == 1
+
+
+def test_pattern_fanout_width(monkeypatch):
+    pattern = Pattern('example.com', None, None, Checker(), min_concurrent=3, max_concurrent=4)
+    monkeypatch.setattr(conf, 'adaptive_concurrent', False)
+    assert pattern.fanout_width() == 4
+    assert Pattern('example.com', None, None, Checker()).fanout_width() == conf.concurrent
+    monkeypatch.setattr(conf, 'adaptive_concurrent', True)
+    monkeypatch.setattr(conf, 'concurrent_target', 0.95)
+    assert pattern.fanout_width() == 4
+    pattern = Pattern('example.com', None, None, Checker(), min_concurrent=3, max_concurrent=4)
+    for _ in range(98):
+        pattern.fanout.record(True, 0.1, 1)
+    assert pattern.fanout_width() == 3
+
+
+def _longest_prefix(patterns, url):
+    # what the old character trie returned: the longest pattern the url without its scheme starts with
+    url = url.split('://', 1)[-1]
+    matches = [p for p in patterns if url.startswith(p)]
+    return max(matches, key=len) if matches else 'public_proxies'
+
+
+def _trie(patterns):
+    return CheckPatternTrie({p: json.dumps({'rule': p, 'value': None}) for p in patterns})
+
+
+def test_closest_pattern_prefers_the_longest_match():
+    t = _trie(['example.com', 'example.com/a', 'example.com/a/b', 'example.co', 'ex', 'other.org/x'])
+    assert t.closest_pattern('https://example.com/a/b/c')[0] == 'example.com/a/b'
+    assert t.closest_pattern('http://example.com/a/c')[0] == 'example.com/a'
+    assert t.closest_pattern('http://example.com/b')[0] == 'example.com'
+    # patterns without a path may stop in the middle of a host
+    assert t.closest_pattern('http://example.cn/')[0] == 'ex'
+    assert t.closest_pattern('http://example.cox/a')[0] == 'example.co'
+    assert t.closest_pattern('http://example.com.cn/a')[0] == 'example.com'
+    assert t.closest_pattern('http://example.com')[0] == 'example.com'
+    # patterns with a path need the whole host
+    assert t.closest_pattern('http://other.org.cn/x')[0] == 'public_proxies'
+    assert t.closest_pattern('http://other.org/xyz')[0] == 'other.org/x'
+    assert t.closest_pattern('http://other.org/y')[0] == 'public_proxies'
+    assert t.closest_pattern('http://example.com/a/b/c')[1] == json.dumps({'rule': 'example.com/a/b', 'value': None})
+
+
+def test_closest_pattern_falls_back_to_public_proxies():
+    t = _trie([])
+    assert t.closest_pattern('http://example.com/') == ('public_proxies', CheckPatternTrie.PUBLIC_RULE_JSON)
+    assert len(t) == 0
+
+
+def test_closest_pattern_cache_follows_adds_and_deletes():
+    t = _trie(['example.com'])
+    url = 'http://example.com/a/b'
+    assert t.closest_pattern(url)[0] == 'example.com'
+    t['example.com/a'] = '{}'
+    assert t.closest_pattern(url)[0] == 'example.com/a'
+    t['example.com/a/b'] = '{}'
+    assert t.closest_pattern(url)[0] == 'example.com/a/b'
+    del t['example.com/a/b']
+    del t['example.com/a']
+    assert t.closest_pattern(url)[0] == 'example.com'
+    del t['example.com']
+    assert t.closest_pattern(url)[0] == 'public_proxies'
+    assert len(t) == 0
+
+
+def test_closest_pattern_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(CheckPatternTrie, 'CACHE_SIZE', 3)
+    t = _trie(['a.com/x'])
+    for i in range(10):
+        t.closest_pattern('http://a.com/x{}'.format(i))
+        t.closest_pattern('http://host{}.org/'.format(i))
+    assert len(t._cache) <= 3
+
+
+def test_closest_pattern_matches_longest_prefix():
+    rnd = random.Random(11)
+
+    def part(n):
+        return ''.join(rnd.choice('ab.') for _ in range(rnd.randint(1, n)))
+    for _ in range(50):
+        patterns = set()
+        for _ in range(rnd.randint(1, 8)):
+            host = part(4)
+            patterns.add(host if rnd.random() < 0.5 else host + '/' + part(3))
+        t = _trie(patterns)
+        for _ in range(50):
+            url = 'http://' + part(5) + rnd.choice(['', '/' + part(4)])
+            assert t.closest_pattern(url)[0] == _longest_prefix(patterns, url), (patterns, url)
+            # cached lookups give the same answer
+            assert t.closest_pattern(url)[0] == _longest_prefix(patterns, url), (patterns, url)
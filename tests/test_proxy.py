@@ -0,0 +1,226 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from config import conf
+from core.crawler import ProxyLoad, crawl
+from models.proxy import Proxy, ProxyCache, ProxyManager, ProxyPool, ScoreIndex, prefer_used_selector
+
+
+def test_added_proxy_is_copied_per_pool(loop, redis):
+    pom = ProxyManager(conf, redis)
+    proxy = Proxy('10.0.0.1', 8080)
+
+    async def run():
+        await pom.cache.pool('example.com')
+        await pom.cache.pool('public_proxies')
+        assert await pom._add_proxies([proxy], 'example.com') == 1
+        mine = await pom.cache.get('example.com', str(proxy))
+        public = await pom.cache.get('public_proxies', str(proxy))
+        assert mine is not public and mine is not proxy
+        mine.score = 3
+        await pom.cache.store('example.com', mine)
+        assert public.score == 0
+        assert [str(p) for p in (await pom.cache.pool('public_proxies')).index.top(1)] == [str(proxy)]
+    loop.run_until_complete(run())
+
+
+def test_cache_reloads_after_another_writer(loop, redis):
+    mine, other = ProxyCache(redis), ProxyCache(redis)
+    proxy = Proxy('10.0.0.2', 8080)
+
+    async def run():
+        assert len(await mine.pool('example.com')) == 0
+        await other.store('example.com', proxy)
+        # the version is only compared once per interval
+        (await mine.pool('example.com')).checked_at = 0
+        assert str(proxy) in (await mine.pool('example.com')).proxies
+    loop.run_until_complete(run())
+
+
+def _proxies(scores, used=False, subnet=1):
+    proxies = list()
+    for i, score in enumerate(scores):
+        proxy = Proxy('10.{}.0.{}'.format(subnet, i), 8080, support_https=i % 2 == 0)
+        proxy.score, proxy.used = score, used
+        proxies.append(proxy)
+    return proxies
+
+
+def test_score_index_matches_full_sort():
+    proxies = _proxies([1, 5, 3, 5, 0, -2, 3]) + _proxies([2, 4], used=True, subnet=2)
+    index = ScoreIndex(proxies)
+    for prefer_used in (True, False):
+        expected = sorted(proxies, key=lambda p: prefer_used_selector(p.score, p.used, prefer_used), reverse=True)
+        top = index.top(4, prefer_used)
+        assert [prefer_used_selector(p.score, p.used, prefer_used) for p in top] == \
+            [prefer_used_selector(p.score, p.used, prefer_used) for p in expected[:4]]
+
+
+def test_score_index_moves_proxy_between_buckets():
+    proxy, other = _proxies([1, 2])
+    index = ScoreIndex([proxy, other])
+    proxy.score = 5
+    index.add(proxy)
+    assert index.top(1) == [proxy]
+    index.remove(str(proxy))
+    assert index.top(2) == [other]
+    assert index.top(0) == []
+
+
+def test_score_index_https_only():
+    index = ScoreIndex(_proxies([5, 4, 3, 2]))
+    assert all(p.support_https for p in index.top(4, need_https=True))
+    assert len(index.top(4, need_https=True)) == 2
+
+
+def test_compact_record_round_trip():
+    proxy = Proxy('10.0.0.3', 3128, valid_time=300, insert_time=1600000000, support_https=True, paid=False,
+                  tag='free|api', delete_time=1600000100)
+    proxy.score, proxy.used = -2, True
+    loaded = Proxy.loads(proxy.dumps(), str(proxy))
+    for field in Proxy.RECORD_FIELDS:
+        assert getattr(loaded, field) == getattr(proxy, field)
+    assert (loaded.ip, loaded.port) == (proxy.ip, proxy.port)
+
+
+def test_legacy_records_are_migrated(loop, redis):
+    legacy = json.dumps({'score': 2, 'ip': '10.0.0.4', 'port': 8080, 'used': True, 'valid_time': -1,
+                         'insert_time': 1600000000, 'tag': 'file', 'paid': False, 'support_https': True})
+    proxy_str = 'http://10.0.0.4:8080'
+    pom = ProxyManager(conf, redis)
+
+    async def run():
+        await redis.hset('example.com', proxy_str, legacy)
+        await redis.hset('example.com_fail', proxy_str, legacy)
+        assert await pom.migrate_records(['example.com']) == 2
+        assert await pom.migrate_records(['example.com']) == 0
+        record = await redis.hget('example.com', proxy_str)
+        assert not Proxy.is_legacy(record)
+        assert Proxy.loads(record, proxy_str).to_dict() == Proxy.loads(legacy, proxy_str).to_dict()
+    loop.run_until_complete(run())
+
+
+def test_empty_pattern_is_served_by_public_proxies_while_it_refills(loop, redis):
+    pom = ProxyManager(conf, redis)
+    public = [Proxy('10.3.0.{}'.format(i), 8080, support_https=True) for i in range(3)]
+    refilling = asyncio.Event()
+
+    async def slow_refill(pattern_str):
+        refilling.set()
+        await asyncio.sleep(60)
+    pom.add_proxies_for_pattern = slow_refill
+
+    async def run():
+        await redis.hmset_dict('public_proxies', {str(p): p.dumps() for p in public})
+        # never waits on the refill
+        selected = await asyncio.wait_for(pom.select_proxies('new.example.com', concurrent=2), 1)
+        assert len(selected) == 2
+        assert {str(p) for p in selected} <= {str(p) for p in public}
+        await asyncio.wait_for(refilling.wait(), 1)
+        await pom.__aexit__(None, None, None)
+    loop.run_until_complete(run())
+
+
+def test_no_proxy_means_no_request(loop):
+    r = loop.run_until_complete(crawl('GET', 'http://example.com/', list()))
+    assert not r.valid
+    assert [f.reason for f in r.failures] == ['no_proxy']
+
+
+class _Pools(object):
+
+    def __init__(self, proxies):
+        self._pool = ProxyPool({str(p): p for p in proxies})
+
+    async def pool(self, pattern_str):
+        return self._pool
+
+
+def _saturated_manager(monkeypatch, scores, busy):
+    # proxies[i] for i in busy are at proxy_max_inflight
+    load = ProxyLoad()
+    monkeypatch.setattr('models.proxy.proxy_load', load)
+    monkeypatch.setattr(conf, 'proxy_max_inflight', 1)
+    monkeypatch.setattr(conf, 'proxy_max_rate', 0)
+    proxies = _proxies(scores)
+    for i in busy:
+        load.start(str(proxies[i]))
+    pom = ProxyManager(conf, None, cache=_Pools(proxies))
+    pom.replenish = lambda pattern_str, proxy_count: None
+    return pom, proxies, load
+
+
+@pytest.mark.parametrize('mode', ['greedy', 'latency'])
+def test_saturated_proxies_are_skipped_and_counted_once(loop, monkeypatch, mode):
+    pom, proxies, load = _saturated_manager(monkeypatch, [5, 4, 3, 2, 1, 0], busy=[0, 5])
+    # same order by latency as by score
+    for i, p in enumerate(proxies):
+        p.latency.record(0.01 * (i + 1), True)
+    selected = loop.run_until_complete(pom.select_proxies('x', mode=mode, concurrent=2))
+    assert [str(p) for p in selected] == [str(proxies[1]), str(proxies[2])]
+    # proxies[5] was never a candidate, it is not counted
+    assert load.skipped == 1
+
+
+def test_shuffle_counts_only_saturated_proxies_it_would_have_picked(loop, monkeypatch):
+    pom, proxies, load = _saturated_manager(monkeypatch, [1, 1, 1, 1], busy=[0])
+    selected = loop.run_until_complete(pom.select_proxies('x', mode='shuffle', prefer_used=False, concurrent=4))
+    assert str(proxies[0]) not in {str(p) for p in selected}
+    assert len(selected) == 3 and load.skipped == 1
+    pom, proxies, load = _saturated_manager(monkeypatch, [1] * 20, busy=[0])
+    for _ in range(20):
+        loop.run_until_complete(pom.select_proxies('x', mode='shuffle', prefer_used=False, concurrent=1))
+    assert load.skipped < 20
+
+
+def test_all_saturated_falls_back_to_least_busy(loop, monkeypatch):
+    pom, proxies, load = _saturated_manager(monkeypatch, [1, 1, 1], busy=[0, 1, 1, 2])
+    selected = loop.run_until_complete(pom.select_proxies('x', mode='greedy', concurrent=2))
+    assert [str(p) for p in selected] == [str(proxies[0]), str(proxies[2])]
+    # only proxies[1] was left out in the end
+    assert load.skipped == 1
+
+
+def test_rate_saturated_proxies_are_reported(monkeypatch):
+    load = ProxyLoad()
+    load.start('http://10.0.0.1:8080')
+    load.finish('http://10.0.0.1:8080')
+    assert load.stats(0, 1)['saturated'] == 1
+    assert load.stats(0, 2)['saturated'] == 0
+
+
+def test_recently_deleted_proxy_is_not_added_back(loop, redis):
+    pom = ProxyManager(conf, redis)
+    now = int(time.time())
+    blocked = Proxy('10.4.0.1', 8080, delete_time=now - 60)
+    public_blocked = Proxy('10.4.0.2', 8080, delete_time=now - 60)
+    expired = Proxy('10.4.0.3', 8080, delete_time=now - ProxyManager.RENEW_TIME - 1)
+
+    async def run():
+        await redis.hset('example.com_fail', str(blocked), blocked.dumps())
+        await redis.hset('public_proxies_fail', str(public_blocked), public_blocked.dumps())
+        await redis.hset('example.com_fail', str(expired), expired.dumps())
+        fresh = [Proxy(p.ip, p.port) for p in (blocked, public_blocked, expired)]
+        assert await pom._add_proxies(fresh, 'example.com') == 1
+        assert set(await redis.hkeys('example.com')) == {str(expired)}
+        assert not await redis.hexists('example.com_fail', str(expired))
+        assert await redis.hexists('example.com_fail', str(blocked))
+        # already in the pattern, not added twice
+        assert await pom._add_proxies([Proxy(expired.ip, expired.port)], 'example.com') == 0
+    loop.run_until_complete(run())
+
+
+def test_add_limit_is_enforced_across_batches(loop, redis, monkeypatch):
+    monkeypatch.setattr(ProxyManager, 'ADD_BATCH_SIZE', 2)
+    pom = ProxyManager(conf, redis)
+    proxies = [Proxy('10.5.0.{}'.format(i), 8080) for i in range(7)]
+
+    async def run():
+        assert await pom._add_proxies(proxies[:2], 'example.com', num=1) == 1
+        assert await pom._add_proxies(proxies[2:], 'example.com', num=3) == 3
+        assert await redis.hlen('example.com') == 4
+        assert await pom.proxy_count('example.com') == 4
+    loop.run_until_complete(run())
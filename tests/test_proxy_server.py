@@ -0,0 +1,36 @@
+import copy
+
+from config import conf
+from core import crawler, proxy_server
+from core.proxy_server import ProxyServer
+
+
+class IpResponse(object):
+
+    async def json(self):
+        return {'origin': '203.0.113.1'}
+
+
+def test_startup_and_cleanup(loop, redis, redis_addr, monkeypatch):
+    async def lookup(method, url, *args, **kwargs):
+        # the self ip lookup crawls, so the session pool has to be there already
+        crawler.session_pool.get()
+        return IpResponse()
+    monkeypatch.setattr(proxy_server, 'crawl', lookup)
+    monkeypatch.setattr('models.proxy.proxy_sources', set())
+    config = copy.copy(conf)
+    config.redis_addr, config.redis_password = redis_addr
+
+    async def run():
+        app = ProxyServer(config)
+        startup = app.core_session(app)
+        await startup.__anext__()
+        assert '203.0.113.1' in app['ips']
+        assert app['pam'].get_pattern('public_proxies') is not None
+        sessions = app['sessions']
+        try:
+            await startup.__anext__()
+        except StopAsyncIteration:
+            pass
+        assert len(sessions) == 0
+    loop.run_until_complete(run())
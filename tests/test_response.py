@@ -0,0 +1,31 @@
+import asyncio
+import gc
+import weakref
+
+from models.response import Failure
+
+
+class Frame(object):
+    pass
+
+
+def test_failure_does_not_keep_the_exception_alive():
+    frame = Frame()
+    ref = weakref.ref(frame)
+
+    def fail(local):
+        raise asyncio.TimeoutError()
+    try:
+        fail(frame)
+    except asyncio.TimeoutError as e:
+        failure = Failure.from_exception('http://10.0.0.1:80', e)
+    del frame
+    gc.collect()
+    assert ref() is None
+    assert (failure.reason, failure.exc_type, failure.detail) == ('timeout', 'TimeoutError', 'TimeoutError')
+    assert failure.render() == 'http://10.0.0.1:80\nTimeoutError: TimeoutError\n'
+
+
+def test_reason_codes_follow_exception_classes():
+    assert Failure.from_exception(None, ConnectionResetError('peer went away')).reason == 'connect'
+    assert Failure.from_exception(None, ValueError('x')).reason == 'error'
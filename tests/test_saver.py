@@ -0,0 +1,38 @@
+from core.saver import Saver
+from core.script import Script
+from models.proxy import Proxy, ProxyCache
+
+
+def _run_saver(loop, redis, outcomes):
+    cache = ProxyCache(redis)
+    proxy = Proxy('10.0.0.1', 8080)
+
+    async def run():
+        await cache.store('example.com', proxy)
+        async with Saver(redis, cache) as saver:
+            for valid in outcomes:
+                await saver._score_counter('example.com', str(proxy), valid)
+        return await redis.hget('example.com', str(proxy)), await redis.hget('example.com_fail', str(proxy))
+    return loop.run_until_complete(run())
+
+
+def test_outcomes_are_flushed_on_exit(loop, redis):
+    record, failed = _run_saver(loop, redis, [True, True, False, True])
+    assert Proxy.loads(record, 'http://10.0.0.1:8080').score == 2
+    assert failed is None
+
+
+def test_failing_proxy_moves_to_fail(loop, redis):
+    record, failed = _run_saver(loop, redis, [False, False, False])
+    assert record is None
+    assert Proxy.loads(failed, 'http://10.0.0.1:8080').delete_time is not None
+
+
+def test_script_runs_by_sha_once_cached(loop, redis):
+    script = Script('return ARGV[1]')
+
+    async def run():
+        assert await script(redis, args=['a']) == 'a'
+        assert await redis.script_exists(script.sha) == [1]
+        assert await script(redis, args=['b']) == 'b'
+    loop.run_until_complete(run())
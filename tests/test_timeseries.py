@@ -0,0 +1,64 @@
+import time
+
+from config import conf
+from core.cluster import _merge
+from models.pattern import Checker, Pattern, PatternManager
+from models.timeseries import TimeSeries
+
+DAY = 24 * 60 * 60
+
+
+def test_ring_wraps_around():
+    series = TimeSeries(1, 5)
+    for now in range(100, 108):
+        series.add(now=now)
+    # positions reused by the last lap hold only their new slot
+    assert series.window(5, now=107) == [1, 1, 1, 1, 1]
+    assert series.get(102) == 0
+    assert series.window(3, now=110) == [0, 0, 0]
+    series.add(2, now=110)
+    assert series.window(5, now=110) == [1, 1, 0, 0, 2]
+
+
+def test_slots_from_an_earlier_lap_read_as_zero():
+    series = TimeSeries(60, DAY)
+    series.add(5, now=1000 * DAY + 600)
+    # the same position exactly one day later is a new slot
+    assert series.get(series.slot(1000 * DAY + 600)) == 5
+    assert series.window(1, now=1001 * DAY + 600) == [0]
+    series.add(now=1001 * DAY + 600)
+    assert series.window(1, now=1001 * DAY + 600) == [1]
+    assert series.to_dict(10, now=1001 * DAY + 600) == {str(series.slot(1001 * DAY + 600)): 1}
+
+
+def test_window_spans_midnight():
+    series = TimeSeries(60, DAY)
+    midnight = 1000 * DAY
+    series.add(3, now=midnight - 30)
+    series.add(4, now=midnight + 30)
+    assert series.window(3, now=midnight + 30) == [0, 3, 4]
+    assert series.to_dict(3, now=midnight + 30) == {str(series.slot(midnight - 30)): 3,
+                                                     str(series.slot(midnight + 30)): 4}
+
+
+def test_status_sums_counters_across_midnight(monkeypatch):
+    monkeypatch.setattr(conf, 'status_resolution', 60)
+    monkeypatch.setattr(conf, 'status_points', 3)
+    midnight = time.mktime(time.strptime('2026-01-02', '%Y-%m-%d'))
+    pattern = Pattern('example.com', None, None, Checker())
+    success, fail = pattern.series(60)
+    # a count from the day before in the same ring position is not shown
+    success.add(7, now=midnight - DAY + 30)
+    success.add(3, now=midnight - 90)
+    fail.add(1, now=midnight - 90)
+    success.add(1, now=midnight + 30)
+    fail.add(1, now=midnight + 30)
+    pam = PatternManager(Checker(), None, None)
+    pam._patterns = {str(pattern): pattern}
+    counters = pam.counters(now=midnight + 30)
+    # summed with another worker's counters the way the cluster snapshot does it
+    other = {str(pattern): {'success': {str(int((midnight - 90) // 60)): 4}, 'fail': {}}}
+    summed = _merge(counters, other)
+    x, items = pam.status(summed, now=midnight + 30)
+    assert x == ['23:58', '23:59', '00:00']
+    assert items == [{'pattern': 'example.com', 'serial': [7 / 8 * 100, 0, 50.0]}]
@@ -0,0 +1,67 @@
+from config import conf
+from core.tunnel import tunnel
+
+
+class Writer(object):
+
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Pattern(object):
+
+    def fanout_width(self):
+        return 3
+
+
+class Index(object):
+
+    def closest_pattern(self, url):
+        return 'public_proxies', None
+
+
+class PatternManager(object):
+    t = Index()
+
+    def get_pattern(self, pattern_str):
+        return Pattern()
+
+
+class ProxyManager(object):
+
+    def __init__(self):
+        self.selected = 0
+
+    async def select_proxies(self, pattern_str, **kwargs):
+        self.selected += 1
+        return list()
+
+
+def _tunnel(loop, target):
+    app = {'config': conf, 'pam': PatternManager(), 'pom': ProxyManager()}
+    writer = Writer()
+    loop.run_until_complete(tunnel(app, None, writer, 'CONNECT {} HTTP/1.1\r\n\r\n'.format(target).encode()))
+    return app, writer
+
+
+def test_ports_outside_the_allow_list_are_refused(loop):
+    app, writer = _tunnel(loop, '127.0.0.1:6379')
+    assert writer.data.startswith(b'HTTP/1.1 403 ')
+    assert writer.closed
+    assert app['pom'].selected == 0
+
+
+def test_no_direct_tunnel_without_a_proxy(loop):
+    _, writer = _tunnel(loop, 'example.com:443')
+    assert writer.data.startswith(b'HTTP/1.1 503 ')
+    assert writer.closed